@@ -7,15 +7,118 @@
 
 
 # pip install --user twisted
-from twisted.internet import protocol, reactor
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.python import failure, threadpool
+import collections
+import functools
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+import json
+import struct
+import sys
+from array import array
 
 DEFAULT_PORT = 17380
+DATABASE_FILE = "rppcs_data.db"
+READER_THREADS = 4 # Read only connections serving fetch requests.
+# Group commit. Mutations arriving within WRITE_BATCH_WINDOW seconds of
+# the first one, up to WRITE_BATCH_SIZE of them, share one transaction.
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WINDOW = 0.005
+# Prepared statements kept per connection. Every command uses a fixed SQL
+# string with bound parameters, so each statement is parsed and planned
+# once per connection and reused from the cache afterwards.
+STATEMENT_CACHE_SIZE = 256
+# Payloads of at least COMPRESSION_THRESHOLD bytes are zlib compressed at
+# COMPRESSION_LEVEL (1 fastest - 9 smallest) for clients that support it.
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 1024
 port = None
-db = None # Will be set later.
+subscribers = dict() # SimpleServer -> t_id filter, None for every tournament.
+data_version = 0 # Last committed change log version seen by the reactor.
+writer = None # DatabaseWriter, set later.
+snapshot_cache = dict() # (fn, args) -> (version, payload) of the last snapshot.
+compressed_snapshots = dict() # (fn, args) -> (payload, compressed payload).
+snapshot_waiters = dict() # (fn, args) -> Deferreds waiting on a snapshot being built.
+snapshot_cache_hits = 0
+snapshot_compress_time = 0.0 # CPU seconds reader threads spent compressing snapshots.
+zlib_connections = 0 # Connections that chose zlib compression.
+reader_pool = None # ThreadPool of read only connections, set later.
 
-# Translate all tables into a dictionary of 2 dimensional lists.
+# Message framing.
+# Every message sent between the client and the server is a frame made of
+# a fixed size header followed by the payload:
+#     [ payload length : 4 bytes ][ message type : 1 byte ][ request id : 4 bytes ]
+# All header fields are unsigned big endian integers. The request id of a
+# command is echoed back in the response to that command. Clients may send
+# many commands without waiting, each is answered as soon as it completes,
+# so a read can be answered before a slow write sent ahead of it.
+FRAME_HEADER = struct.Struct("!IBI")
+MAX_FRAME_LENGTH = 1 << 28 # 256 MiB, anything larger is a corrupt stream.
+
+MSG_COMMAND = 1  # Client -> Server, JSON [ name, arguments... ], see COMMANDS.
+MSG_FINISHED = 2 # Server -> Client, command has been completed.
+MSG_SNAPSHOT = 3 # Server -> Client, binary fetchall snapshot.
+MSG_ERROR = 4    # Server -> Client, command failed, payload is the reason.
+MSG_DELTA = 5    # Server -> Client, JSON list of changes, see fetch_since().
+MSG_IDS = 6      # Server -> Client, first id of an allocated range as text.
+MSG_STATS = 7    # Server -> Client, JSON per command call counts and timings.
+MSG_HELLO = 8    # Server -> Client, JSON of the options chosen by hello.
+MSG_TOURNAMENT = 9 # Server -> Client, binary snapshot of a single tournament.
+
+# Set in the message type of a frame whose payload is zlib compressed.
+FLAG_COMPRESSED = 0x80
+COMPRESSION_SCHEMES = ("zlib",) # In order of preference.
+
+# Request id of messages the server sends without being asked, e.g. the
+# changes pushed to subscribers. Clients never use it for a command.
+PUSH_REQUEST_ID = 0
+
+# Number of change log entries kept for delta syncing. Clients that fall
+# further behind than this are sent a full snapshot instead.
+CHANGE_LOG_LIMIT = 200000
+# The writer prunes the log each time this many versions were added.
+CHANGE_LOG_PRUNE_INTERVAL = 10000
+
+def encode_frame(msg_type : int, request_id : int, payload : bytes):
+    return FRAME_HEADER.pack(len(payload), msg_type, request_id) + payload
+
+# Incremental frame decoder. Bytes are fed in exactly as TCP hands them
+# over and complete frames are returned as soon as they are available.
+# Each byte is copied into the buffer once and sliced out once, so a large
+# payload split over many chunks is still decoded in linear time.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    # Returns a list of (msg_type, request_id, payload) tuples.
+    def feed(self, data : bytes):
+        self.buffer += data
+        frames = list()
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            length, msg_type, request_id = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_LENGTH:
+                raise ValueError(f"Frame length {length} exceeds maximum.")
+            start = offset + FRAME_HEADER.size
+            end = start + length
+            if len(self.buffer) < end:
+                break # Wait for the rest of the payload.
+            frames.append((msg_type, request_id, bytes(self.buffer[start:end])))
+            offset = end
+        # Deleting from the front of a bytearray does not move the data.
+        del self.buffer[:offset]
+        return frames
+
+# END class FrameDecoder
+
+# Binary columnar snapshot of every table, sent in response to fetchall.
 """
+The client rebuilds these dictionaries from the snapshot:
+
 ret["TT"] = [T]ournament [T]able dictionary
 ret["MT"] = [M]atch [T]able dictionary
 ret["GT"] = [G]ame [T]able dictionary
@@ -27,42 +130,206 @@ ret["MT"][id] = [ t_id, p1_id, p2_id ]
 ret["GT"][id] = [ m_id, p1_score, p2_score ]
 ret["PT"][id] = [ name, skill ]
 ret["BT"][parent_id] = [ l_child_id, r_child_id ]
+
+Layout (integers in the header fields are unsigned big endian):
+    [ data version : 8 bytes ]
+    [ string table length : 4 bytes ][ string table ]
+    for each table in SNAPSHOT_TABLES order:
+        [ row count : 4 bytes ]
+        for each column: [ row count items of the column's array type ]
+
+The string table is every distinct name and date, UTF-8 encoded and
+joined with NUL characters. String columns hold indices into it.
+Column arrays are little endian. NULL integers are stored as -1.
 """
-def fetchall():
-    global db
+# Column kinds: 'i' integer, 'n' nullable integer, 's' string.
+# Must match SNAPSHOT_TABLES in qt/main.py.
+SNAPSHOT_TABLES = (
+    ("TT", "tournaments", ("id", "name", "numplayers", "date"),   "isis"),
+    ("MT", "matches",     ("id", "t_id", "p1_id", "p2_id"),        "iinn"),
+    ("GT", "games",       ("id", "m_id", "p1_score", "p2_score"),  "iiii"),
+    ("PT", "players",     ("id", "name", "skill"),                 "nsi"),
+    ("BT", "match_tree",  ("parent_id", "l_child_id", "r_child_id"), "iii"),
+)
+SNAPSHOT_TYPECODES = { 'i' : 'q', 'n' : 'q', 's' : 'I' }
+
+def encode_snapshot(version, tables):
+    strings = dict() # string -> index in the string table
+    body = list()
+    for key, table, columns, kinds in SNAPSHOT_TABLES:
+        rows = tables[key]
+        body.append(struct.pack("!I", len(rows)))
+        for i, kind in enumerate(kinds):
+            values = [ row[i] for row in rows ]
+            if kind == 's':
+                values = [ strings.setdefault(v, len(strings)) for v in values ]
+            col = array(SNAPSHOT_TYPECODES[kind], values)
+            if sys.byteorder == "big":
+                col.byteswap()
+            body.append(col.tobytes())
+
+    string_table = "\0".join(strings).encode()
+    header = struct.pack("!QI", version, len(string_table))
+    return header + string_table + b"".join(body)
+
+# Reads a snapshot of the rows matching conditions, a dictionary of table
+# key -> SQL condition. Tables without a condition are read in full. The
+# condition may refer to the tournament id as :t_id.
+def fetch_snapshot(db, conditions, t_id = None):
     cur = db.cursor()
-    
-    ret = dict()
+    version = current_version(db)
 
-    cur.execute("SELECT * FROM tournaments")
-    ret["TT"] = dict()
-    for row in cur:
-        ret["TT"][row[0]] = list(row)[1:]
+    tables = dict()
+    for key, table, columns, kinds in SNAPSHOT_TABLES:
+        # NULL ids are translated to -1 by sqlite rather than in python.
+        select = ", ".join(f"IFNULL({c}, -1)" if k == 'n' else c
+                           for c, k in zip(columns, kinds))
+        where = conditions.get(key, "1")
+        cur.execute(f"SELECT {select} FROM {table} WHERE {where}", { "t_id" : t_id })
+        tables[key] = cur.fetchall()
 
-    cur.execute("SELECT * FROM matches")
-    ret["MT"] = dict()
-    for row in cur:
-        ret["MT"][row[0]] = list(row)[1:]
+    return encode_snapshot(version, tables)
 
-    cur.execute("SELECT * FROM games")
-    ret["GT"] = dict()
-    for row in cur:
-        ret["GT"][row[0]] = list(row)[1:]
-    
-    cur.execute("SELECT * FROM players")
-    ret["PT"] = dict()
-    for row in cur:
-        ret["PT"][row[0]] = list(row)[1:]
+# Rows belonging to one tournament. Players are the ones its matches
+# reference, the null player included.
+TOURNAMENT_ROWS = {
+    "TT" : "id = :t_id",
+    "MT" : "t_id = :t_id",
+    "GT" : "m_id IN (SELECT id FROM matches WHERE t_id = :t_id)",
+    "PT" : """id IS NULL OR id IN (SELECT p1_id FROM matches WHERE t_id = :t_id
+                                   UNION SELECT p2_id FROM matches WHERE t_id = :t_id)""",
+    "BT" : "parent_id IN (SELECT id FROM matches WHERE t_id = :t_id)",
+}
 
-    cur.execute("SELECT * FROM match_tree")
-    ret["BT"] = dict()
+def fetchall(db):
+    return fetch_snapshot(db, {})
+
+# A single tournament, loaded by clients when it is selected.
+def fetch_tournament(db, t_id : int):
+    return fetch_snapshot(db, TOURNAMENT_ROWS, t_id)
+
+# Every tournament and player, which clients list, plus the matches, games
+# and tree of tournament t_id only. None loads no matches at all.
+def fetch_shared(db, t_id):
+    conditions = { key : "0" if t_id is None else TOURNAMENT_ROWS[key]
+                   for key in ("MT", "GT", "BT") }
+    return fetch_snapshot(db, conditions, t_id)
+
+# Every insert, update and delete on the five tables is recorded in the
+# change_log table by triggers, including rows removed or changed by
+# ON DELETE CASCADE / SET NULL. The version of an entry is its position in
+# the log, so the database version is the last version handed out.
+# Entries also record the tournament they belong to so subscribers can
+# filter by tournament. Tournaments and players are shared by every
+# tournament and are logged with a NULL t_id, as are rows whose match was
+# already removed by a cascade.
+CHANGE_LOG_TOURNAMENT = {
+    "TT" : lambda row : "NULL",
+    "MT" : lambda row : f"{row}.t_id",
+    "GT" : lambda row : f"(SELECT t_id FROM matches WHERE id = {row}.m_id)",
+    "PT" : lambda row : "NULL",
+    "BT" : lambda row : f"(SELECT t_id FROM matches WHERE id = {row}.parent_id)",
+}
+
+def create_change_log_triggers(db):
+    cur = db.cursor()
+    for key, table, columns, kinds in SNAPSHOT_TABLES:
+        for op, event, row in (('I', "INSERT", "NEW"),
+                               ('U', "UPDATE", "NEW"),
+                               ('D', "DELETE", "OLD")):
+            names = [ "row_id" ] + [ f"c{i}" for i in range(1, len(columns)) ]
+            values = [ f"{row}.{c}" for c in columns ]
+            if op == 'D':
+                names = names[:1]
+                values = values[:1]
+            names.append("t_id")
+            values.append(CHANGE_LOG_TOURNAMENT[key](row))
+            # Recreated every start so older databases pick up changes.
+            cur.execute(f"DROP TRIGGER IF EXISTS log_{table}_{event.lower()}")
+            cur.execute(f"""CREATE TRIGGER log_{table}_{event.lower()}
+                            AFTER {event} ON {table} BEGIN
+                                INSERT INTO change_log (tbl, op, {", ".join(names)})
+                                VALUES ('{key}', '{op}', {", ".join(values)});
+                            END""")
+    db.commit()
+
+def current_version(db):
+    cur = db.cursor()
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+    row = cur.fetchone()
+    return 0 if row is None else row[0]
+
+def prune_change_log(db):
+    cur = db.cursor()
+    cur.execute("DELETE FROM change_log WHERE version <= ?",
+                (current_version(db) - CHANGE_LOG_LIMIT,))
+
+# Returns the changes made after the given version as a list of
+# (t_id, [ version, key, op, row_id, values... ]) tuples where key is the
+# client table key ("TT", "MT", ...), op is 'I', 'U' or 'D' and values are
+# the row's columns after the change (none for deletes).
+def read_changes(db, version : int):
+    cur = db.cursor()
+    widths = { key : len(columns) - 1 for key, table, columns, kinds in SNAPSHOT_TABLES }
+    changes = list()
+    cur.execute("""SELECT version, tbl, op, row_id, c1, c2, c3, t_id FROM change_log
+                   WHERE version > ? ORDER BY version""", (version,))
     for row in cur:
-        ret["BT"][row[0]] = list(row)[1:]
-    
-    return ret
+        width = 0 if row[2] == 'D' else widths[row[1]]
+        changes.append((row[7], row[:4 + width]))
+    return changes
 
-def create_debug_testing_data():
-    global db
+def encode_delta(version : int, changes):
+    return json.dumps({ "version" : version, "changes" : changes }).encode()
+
+# Returns the changes made after the given version encoded as
+#     { "version" : v, "changes" : [ [ version, key, op, row_id, values... ], ... ] }
+# Only changes to tournament t_id and the shared tables are included, or
+# every change if t_id is None, the same as subscriptions.
+# Returns None if the log no longer reaches back that far.
+def fetch_since(db, version : int, t_id = None):
+    cur = db.cursor()
+    cur.execute("SELECT MIN(version) FROM change_log")
+    oldest = cur.fetchone()[0]
+    latest = current_version(db)
+    if version > latest:
+        return None # Client is ahead, the database must have been replaced.
+    if version < latest and (oldest is None or oldest > version + 1):
+        return None
+
+    changes = [ change for change_t_id, change in read_changes(db, version)
+                if t_id is None or change_t_id is None or change_t_id == t_id ]
+    return encode_delta(latest, changes)
+
+# Answer to fetch_since, falling back to a snapshot of the same scope when
+# the change log no longer reaches back to the client's version. Returns
+# the message type and payload to send.
+def sync_since(db, version : int, t_id):
+    delta = fetch_since(db, version, t_id)
+    if delta is None:
+        return MSG_SNAPSHOT, fetchall(db) if t_id is None else fetch_shared(db, t_id)
+    return MSG_DELTA, delta
+
+# Push changes committed by the writer thread to the subscribed
+# connections. Runs on the reactor thread right after each commit, so
+# mutations made through any connection reach every other client without
+# polling.
+def broadcast_changes(latest : int, changes):
+    global data_version
+    data_version = latest
+    snapshot_cache.clear() # Out of date, rebuilt by the next request.
+    compressed_snapshots.clear()
+
+    for connection, t_filter in list(subscribers.items()):
+        if t_filter is None:
+            selected = [ change for t_id, change in changes ]
+        else:
+            selected = [ change for t_id, change in changes
+                         if t_id is None or t_id == t_filter ]
+        if selected:
+            connection.send(MSG_DELTA, PUSH_REQUEST_ID, encode_delta(latest, selected))
+
+def create_debug_testing_data(db):
 
     cur = db.cursor()
 
@@ -102,74 +369,67 @@ def create_debug_testing_data():
     cur.execute("INSERT INTO match_tree (parent_id, l_child_id, r_child_id) VALUES (2, 0, 1)")
     db.commit()
 
-def get_match_game_id_lists(matches : int):
-    m_ids = list()
-    g_ids = list()
-
-    taken_matches = set()
-    taken_games = set()
-    
-    global db
-    cur = db.cursor()
-    cur.execute("SELECT * FROM matches")
-    for row in cur:
-        taken_matches.add(row[0]) # NEED TO CAST TO INT?
-
-    cur.execute("SELECT * FROM games")
-    for row in cur:
-        taken_games.add(row[0]) # NEED TO CAST TO INT?
+# Tables whose ids are handed out by allocate_ids().
+ID_SEQUENCE_TABLES = ("tournaments", "matches", "games", "players")
+# Largest bracket create_tournament() builds.
+MAX_TOURNAMENT_PLAYERS = 1 << 16
+# Most ids allocate_ids() hands out at once, enough for the games of the
+# largest bracket. Larger requests could use up the id space.
+MAX_ALLOCATE_IDS = (MAX_TOURNAMENT_PLAYERS - 1) * 7
 
-    i = 0
-    while len(m_ids) < matches:
-        if i not in taken_matches:
-            m_ids.append(i)
-        i += 1
+# Reserve count consecutive ids in a table and return the first one.
+# The next free id of each table is kept in id_sequences, so this costs a
+# single row lookup however large the table is. Ids are never handed out
+# twice, even to different clients. Must be called inside a transaction.
+def allocate_ids(db, table : str, count : int):
+    if table not in ID_SEQUENCE_TABLES:
+        raise ValueError(f"No id sequence for table {table}.")
+    if count < 1:
+        raise ValueError("Must allocate at least one id.")
+    if count > MAX_ALLOCATE_IDS:
+        raise ValueError(f"Cannot allocate more than {MAX_ALLOCATE_IDS} ids at once.")
 
-    i = 0
-    while len(g_ids) < matches * 7:
-        if i not in taken_games:
-            g_ids.append(i)
-        i += 1
+    cur = db.cursor()
+    cur.execute("SELECT next_id FROM id_sequences WHERE tbl = ?", (table,))
+    first = cur.fetchone()[0]
+    cur.execute("UPDATE id_sequences SET next_id = ? WHERE tbl = ?",
+                (first + count, table))
+    return first
 
-    return m_ids, g_ids
+def get_match_game_id_lists(db, matches : int):
+    m_start = allocate_ids(db, "matches", matches)
+    g_start = allocate_ids(db, "games", matches * 7)
+    return range(m_start, m_start + matches), range(g_start, g_start + matches * 7)
 
-def create_tournament(t_id : int, name : str, players : int):
-    if players % 2 == 1:
-        players += 1
+# Build the complete bracket for a tournament in memory. Returns the rows
+# for the matches, games and match_tree tables, in insertion order.
+def build_bracket(t_id : int, players : int, m_ids, g_ids):
+    match_rows = list()
+    game_rows = list()
+    tree_rows = list()
     
     matches = players - 1
 
-    global db
-    cur = db.cursor()
-
-    # Create tournament
-    cur.execute("INSERT INTO tournaments (id, name, numplayers, date) VALUES (?, ?, ?, DATE('now'))",
-                (t_id, name, players))
-    db.commit()
-
-    # Get valid id numbers from the database
-    m_ids, g_ids = get_match_game_id_lists(matches)
-    # Create matches
     m_i = 0
     g_i = 0
+
+    def add_match():
+        nonlocal g_i
+        match_rows.append((m_ids[m_i], t_id))
+        for j in range(7):
+            game_rows.append((g_ids[g_i], m_ids[m_i]))
+            g_i += 1
     
     # Matches originating from players
     last_odd_id0 = None
     last_odd_id1 = None
     for i in range(players // 2):
-        cur.execute("INSERT INTO matches (id, t_id, p1_id, p2_id) VALUES (?, ?, NULL, NULL)",
-                    (m_ids[m_i], t_id))
-        db.commit()
+        add_match()
         
         if (players // 2) % 2 == 1 and i == (players // 2) - 1:
             last_odd_id0 = m_ids[m_i]
                 
-        for j in range(7):
-            cur.execute("INSERT INTO games (id, m_id, p1_score, p2_score) VALUES (?, ?, 0, 0)",
-                        (g_ids[g_i], m_ids[m_i]))
-            g_i += 1
         m_i += 1
-        db.commit()
 
     last_col_count = players // 2
     matches -= last_col_count
@@ -179,12 +439,8 @@ def create_tournament(t_id : int, name : str, players : int):
         match_col_count = last_col_count // 2
             
         for i in range(match_col_count):
-            cur.execute("INSERT INTO matches (id, t_id, p1_id, p2_id) VALUES (?, ?, NULL, NULL)",
-                        (m_ids[m_i], t_id))
-            db.commit()
-            cur.execute("INSERT INTO match_tree (parent_id, l_child_id, r_child_id) VALUES (?, ?, ?)",
-                        (m_ids[m_i], m_ids[m_i - last_col_count + i], m_ids[m_i - last_col_count + i + 1]))
-            db.commit()
+            add_match()
+            tree_rows.append((m_ids[m_i], m_ids[m_i - last_col_count + i], m_ids[m_i - last_col_count + i + 1]))
 
             if matches == 2 or (match_col_count % 2 == 1 and i == match_col_count - 1 and match_col_count != 1):
                 if last_odd_id0 is None:
@@ -193,70 +449,176 @@ def create_tournament(t_id : int, name : str, players : int):
                     last_odd_id1 = m_ids[m_i]
                     is_straggler_col = True
 
-            for j in range(7):
-                cur.execute("INSERT INTO games (id, m_id, p1_score, p2_score) VALUES (?, ?, 0, 0)",
-                            (g_ids[g_i], m_ids[m_i]))
-                g_i += 1
             m_i += 1
-            db.commit()
 
         # Account for straggler match
         if not is_straggler_col and last_odd_id0 is not None and last_odd_id1 is not None:
-            cur.execute("INSERT INTO matches (id, t_id, p1_id, p2_id) VALUES (?, ?, NULL, NULL)",
-                        (m_ids[m_i], t_id))
-            db.commit()
-            cur.execute("INSERT INTO match_tree (parent_id, l_child_id, r_child_id) VALUES (?, ?, ?)",
-                        (m_ids[m_i], last_odd_id1, last_odd_id0))
-            db.commit()
+            add_match()
+            tree_rows.append((m_ids[m_i], last_odd_id1, last_odd_id0))
             last_odd_id0 = None
             last_odd_id1 = None
-            for j in range(7):
-                cur.execute("INSERT INTO games (id, m_id, p1_score, p2_score) VALUES (?, ?, 0, 0)",
-                            (g_ids[g_i], m_ids[m_i]))
-                g_i += 1
 
             # if this match is another straggler match, mark it as such.
             if match_col_count % 2 == 0:
                 last_odd_id0 = m_ids[m_i]
             
             m_i += 1
-            db.commit()
             match_col_count += 1 # We added a match
         
         is_straggler_col = False
         last_col_count = match_col_count
         matches -= last_col_count
 
+    return match_rows, game_rows, tree_rows
+
+# Like every mutation this runs on the writer thread inside its own
+# savepoint (see DatabaseWriter), so either the whole bracket is created
+# or, if anything fails, none of it is.
+def create_tournament(db, t_id : int, name : str, players : int):
+    if players % 2 == 1:
+        players += 1
+    if not 2 <= players <= MAX_TOURNAMENT_PLAYERS:
+        raise ValueError(f"A tournament has 2 to {MAX_TOURNAMENT_PLAYERS} players.")
+
+    cur = db.cursor()
+
+    # Get valid id numbers from the database
+    m_ids, g_ids = get_match_game_id_lists(db, players - 1)
+    match_rows, game_rows, tree_rows = build_bracket(t_id, players, m_ids, g_ids)
+
+    cur.execute("INSERT INTO tournaments (id, name, numplayers, date) VALUES (?, ?, ?, DATE('now'))",
+                (t_id, name, players))
+    cur.executemany("INSERT INTO matches (id, t_id, p1_id, p2_id) VALUES (?, ?, NULL, NULL)",
+                    match_rows)
+    cur.executemany("INSERT INTO games (id, m_id, p1_score, p2_score) VALUES (?, ?, 0, 0)",
+                    game_rows)
+    cur.executemany("INSERT INTO match_tree (parent_id, l_child_id, r_child_id) VALUES (?, ?, ?)",
+                    tree_rows)
+
+    # Large brackets add thousands of log entries at once.
+    prune_change_log(db)
     return
 
-def create_player(p_id : int, name : str, skill : int):
-    global db
+def create_player(db, p_id : int, name : str, skill : int):
     cur = db.cursor()
     cur.execute("INSERT INTO players (id, name, skill) VALUES (?, ?, ?)",
                 (p_id, name, skill))
-    db.commit()
     return
 
-def delete_player(p_id : int):
-    global db
+def delete_player(db, p_id : int):
     cur = db.cursor()
-    cur.execute(f"DELETE FROM players WHERE id = {p_id}")
-    db.commit()
+    cur.execute("DELETE FROM players WHERE id = ?", (p_id,))
     return
 
-def delete_tournament(t_id : int):
-    global db
+def delete_tournament(db, t_id : int):
     cur = db.cursor()
-    cur.execute(f"DELETE FROM tournaments WHERE id = {t_id}")
-    db.commit()
+    cur.execute("DELETE FROM tournaments WHERE id = ?", (t_id,))
+    return
+
+# slot is 1 or 2. Only that player's score is written, so clients editing
+# the other one do not overwrite each other.
+def set_score(db, g_id : int, slot : int, score : int):
+    cur = db.cursor()
+    if slot == 1:
+        cur.execute("UPDATE games SET p1_score = ? WHERE id = ?", (score, g_id))
+    elif slot == 2:
+        cur.execute("UPDATE games SET p2_score = ? WHERE id = ?", (score, g_id))
+    else:
+        raise ValueError(f"Invalid player slot {slot}.")
+    return
+
+# scores is a list of [ g_id, slot, score ] as taken by set_score, so a
+# client can send every score it changed in one message.
+def set_scores(db, scores : list):
+    for score in scores:
+        if not isinstance(score, list):
+            raise ValueError("Every score of set_scores must be a list.")
+        check_arguments("set_scores", score, (int, int, int))
+        if score[1] not in (1, 2):
+            raise ValueError(f"Invalid player slot {score[1]}.")
+    cur = db.cursor()
+    cur.executemany("UPDATE games SET p1_score = ? WHERE id = ?",
+                    [ (score, g_id) for g_id, slot, score in scores if slot == 1 ])
+    cur.executemany("UPDATE games SET p2_score = ? WHERE id = ?",
+                    [ (score, g_id) for g_id, slot, score in scores if slot == 2 ])
+    return
+
+# slot is 1 or 2, p_id None is the null player.
+def set_match_player(db, m_id : int, slot : int, p_id):
+    cur = db.cursor()
+    if slot == 1:
+        cur.execute("UPDATE matches SET p1_id = ? WHERE id = ?", (p_id, m_id))
+    elif slot == 2:
+        cur.execute("UPDATE matches SET p2_id = ? WHERE id = ?", (p_id, m_id))
+    else:
+        raise ValueError(f"Invalid player slot {slot}.")
+    return
+
+def rename_tournament(db, t_id : int, name : str):
+    cur = db.cursor()
+    cur.execute("UPDATE tournaments SET name = ? WHERE id = ?", (name, t_id))
+    return
+
+def rename_player(db, p_id : int, name : str):
+    cur = db.cursor()
+    cur.execute("UPDATE players SET name = ? WHERE id = ?", (name, p_id))
     return
 
+def set_player_skill(db, p_id : int, skill : int):
+    cur = db.cursor()
+    cur.execute("UPDATE players SET skill = ? WHERE id = ?", (skill, p_id))
+    return
+
+# Secondary indexes created by init(). The id column is included so that
+# looking up the ids of a tournament's matches or a match's games never
+# has to touch the table itself.
+INDEXES = (
+    ("matches_t_id",          "matches",    "t_id, id"),
+    ("matches_p1_id",         "matches",    "p1_id"),
+    ("matches_p2_id",         "matches",    "p2_id"),
+    ("games_m_id",            "games",      "m_id, id"),
+    ("match_tree_l_child_id", "match_tree", "l_child_id"),
+    ("match_tree_r_child_id", "match_tree", "r_child_id"),
+)
+
+# Queries run for every command or for every row of a cascade. The foreign
+# key lookups are the ones sqlite runs internally for ON DELETE actions.
+HOT_QUERIES = (
+    "SELECT id FROM matches WHERE t_id = ?",
+    "SELECT id FROM matches WHERE p1_id = ?",
+    "SELECT id FROM matches WHERE p2_id = ?",
+    "SELECT id FROM games WHERE m_id = ?",
+    "SELECT parent_id FROM match_tree WHERE parent_id = ?",
+    "SELECT parent_id FROM match_tree WHERE l_child_id = ?",
+    "SELECT parent_id FROM match_tree WHERE r_child_id = ?",
+    "SELECT t_id FROM matches WHERE id = ?",
+    "SELECT * FROM change_log WHERE version > ?",
+    "SELECT * FROM games WHERE m_id IN (SELECT id FROM matches WHERE t_id = ?)",
+    "SELECT * FROM match_tree WHERE parent_id IN (SELECT id FROM matches WHERE t_id = ?)",
+    "SELECT * FROM players WHERE id IN (SELECT p1_id FROM matches WHERE t_id = ?)",
+    "SELECT next_id FROM id_sequences WHERE tbl = ?",
+    "UPDATE games SET p1_score = ? WHERE id = ?",
+    "UPDATE matches SET p1_id = ? WHERE id = ?",
+    "DELETE FROM tournaments WHERE id = ?",
+    "DELETE FROM players WHERE id = ?",
+)
+
+# Warn about any hot query that sqlite would answer with a full scan.
+def check_query_plans(db):
+    cur = db.cursor()
+    for query in HOT_QUERIES:
+        params = (None,) * query.count('?')
+        for row in cur.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall():
+            detail = row[3]
+            if detail.startswith("SCAN"):
+                print(f"Warning: full scan ({detail}) for query: {query}")
+
 def init():
-    global db
-    db = sqlite3.connect("rppcs_data.db")
+    db = open_connection()
     cur = db.cursor()
-    cur.execute("PRAGMA foreign_keys = ON")
-    db.commit()
+    # Write ahead logging lets the reader threads keep reading while the
+    # writer thread commits. The setting is stored in the database file.
+    cur.execute("PRAGMA journal_mode = WAL")
     
     # Tournament table
     cur.execute("""CREATE TABLE IF NOT EXISTS tournaments(id         INT UNSIGNED NOT NULL PRIMARY KEY,
@@ -296,6 +658,37 @@ def init():
                                                          FOREIGN KEY (l_child_id) REFERENCES matches(id) ON DELETE CASCADE,
                                                          FOREIGN KEY (r_child_id) REFERENCES matches(id) ON DELETE CASCADE)""")
     db.commit()
+
+    # Indexes for the foreign key columns. Without them ON DELETE CASCADE
+    # and SET NULL have to scan the whole child table for every parent
+    # row. CREATE INDEX IF NOT EXISTS also adds them to older databases.
+    for name, table, columns in INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+    db.commit()
+
+    # Next free id of each table, see allocate_ids(). Existing databases
+    # start after the largest id already in use.
+    cur.execute("""CREATE TABLE IF NOT EXISTS id_sequences(tbl     TEXT NOT NULL PRIMARY KEY,
+                                                           next_id INT UNSIGNED NOT NULL)""")
+    for table in ID_SEQUENCE_TABLES:
+        cur.execute("INSERT OR IGNORE INTO id_sequences (tbl, next_id) VALUES (?, 0)", (table,))
+        cur.execute(f"""UPDATE id_sequences SET next_id = MAX(next_id, (SELECT IFNULL(MAX(id) + 1, 0) FROM {table}))
+                        WHERE tbl = ?""", (table,))
+    db.commit()
+
+    # Change log used for delta syncing, see create_change_log_triggers(db).
+    cur.execute("""CREATE TABLE IF NOT EXISTS change_log(version INTEGER PRIMARY KEY AUTOINCREMENT,
+                                                         tbl     TEXT NOT NULL,
+                                                         op      TEXT NOT NULL,
+                                                         row_id  INT,
+                                                         c1, c2, c3,
+                                                         t_id    INT)""")
+    columns = [ row[1] for row in cur.execute("PRAGMA table_info(change_log)") ]
+    if "t_id" not in columns:
+        cur.execute("ALTER TABLE change_log ADD COLUMN t_id INT")
+    db.commit()
+    create_change_log_triggers(db)
+    prune_change_log(db)
     
     # Insert the null player into the players table if necessary.
     # Null player will have an id of NULL (translates to None).
@@ -304,44 +697,400 @@ def init():
         cur.execute("INSERT INTO players (id, name, skill) VALUES (NULL, 'N/A', 0)")
         
     db.commit()
+
+    global data_version
+    data_version = current_version(db)
+
+    check_query_plans(db)
+    db.close()
+
+def open_connection(read_only = False):
+    if read_only:
+        db = sqlite3.connect(f"file:{DATABASE_FILE}?mode=ro", uri = True,
+                             cached_statements = STATEMENT_CACHE_SIZE)
+    else:
+        db = sqlite3.connect(DATABASE_FILE, cached_statements = STATEMENT_CACHE_SIZE)
+    db.execute("PRAGMA foreign_keys = ON")
+    return db
+
+# Owns the only writable connection. Mutations are queued from the reactor
+# thread and run on this thread, so a slow create_tournament never blocks
+# the network loop. Mutations are grouped into batches that are committed
+# as a single transaction (one fsync for a burst of score updates), each
+# one inside its own savepoint so a failing mutation does not undo the
+# rest of its batch. A job's Deferred only fires once its batch has
+# committed. After every commit the new change log entries are handed to
+# broadcast_changes() before the Deferreds fire, so pushes always go out
+# ahead of the acks.
+class DatabaseWriter(threading.Thread):
+    def __init__(self, batch_size = WRITE_BATCH_SIZE, batch_window = WRITE_BATCH_WINDOW):
+        super().__init__(name = "DatabaseWriter", daemon = True)
+        self.jobs = queue.Queue()
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+
+    # Called on the reactor thread. fn(db, *args) runs on the writer thread
+    # and the returned Deferred fires on the reactor thread with its result.
+    def submit(self, fn, *args):
+        d = defer.Deferred()
+        self.jobs.put((d, fn, args))
+        return d
+
+    # Finish every queued job, then close the connection.
+    def stop(self):
+        self.jobs.put(None)
+        self.join()
+
+    # Wait for the first job, then collect more until the batch is full
+    # or the window has passed. Returns the batch and whether to stop.
+    def next_batch(self):
+        job = self.jobs.get()
+        if job is None:
+            return list(), True
+        batch = [ job ]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                return batch, True
+            batch.append(job)
+        return batch, False
+
+    # Returns a list of (Deferred, result or Failure) for the batch.
+    def run_batch(self, db, batch):
+        outcomes = list()
+        cur = db.cursor()
+        try:
+            cur.execute("BEGIN")
+            for d, fn, args in batch:
+                cur.execute("SAVEPOINT job")
+                try:
+                    result = fn(db, *args)
+                except Exception:
+                    outcomes.append((d, failure.Failure()))
+                    cur.execute("ROLLBACK TO job")
+                else:
+                    outcomes.append((d, result))
+                cur.execute("RELEASE job")
+            db.commit()
+        except Exception:
+            # The transaction itself failed, nothing in it was saved.
+            reason = failure.Failure()
+            if db.in_transaction:
+                db.rollback()
+            return [ (d, reason) for d, fn, args in batch ]
+        return outcomes
+
+    def run(self):
+        db = open_connection()
+        version = current_version(db)
+        pruned = version # Version at the last prune.
+        stopping = False
+        while not stopping:
+            batch, stopping = self.next_batch()
+            if not batch:
+                continue
+            outcomes = self.run_batch(db, batch)
+
+            latest = current_version(db)
+            if latest != version:
+                reactor.callFromThread(broadcast_changes, latest, read_changes(db, version))
+                version = latest
+            for d, outcome in outcomes:
+                if isinstance(outcome, failure.Failure):
+                    reactor.callFromThread(d.errback, outcome)
+                else:
+                    reactor.callFromThread(d.callback, outcome)
+
+            # Done after the responses so they are not held up by it.
+            if version - pruned >= CHANGE_LOG_PRUNE_INTERVAL:
+                prune_change_log(db)
+                db.commit()
+                pruned = version
+        db.close()
+
+# END class DatabaseWriter
+
+reader_connection = threading.local()
+
+# Runs on a reader pool thread. Each thread keeps its own read only
+# connection and every call sees a single consistent version of the data.
+def run_read_transaction(fn, *args):
+    db = getattr(reader_connection, "db", None)
+    if db is None:
+        db = reader_connection.db = open_connection(read_only = True)
+    db.execute("BEGIN")
+    try:
+        return fn(db, *args)
+    finally:
+        db.rollback()
+
+def run_read(fn, *args):
+    return threads.deferToThreadPool(reactor, reader_pool, run_read_transaction, fn, *args)
+
+def run_write(fn, *args):
+    return writer.submit(fn, *args)
+
+# Runner for snapshot commands. Each encoded snapshot is kept in memory
+# tagged with the data version it was read at, and served as is until a
+# commit moves data_version on. Requests arriving while a snapshot is being
+# built wait for that build, so many clients connecting at once cost one
+# build.
+def run_cached_snapshot(fn, *args):
+    global snapshot_cache_hits
+    # fn is a new timed_command() wrapper for every request, key on the
+    # command function itself.
+    key = (getattr(fn, "__wrapped__", fn), args)
+    cached = snapshot_cache.get(key)
+    if cached is not None and cached[0] == data_version:
+        snapshot_cache_hits += 1
+        return defer.succeed(cached[1])
+
+    d = defer.Deferred()
+    if key not in snapshot_waiters:
+        snapshot_waiters[key] = [ d ]
+        run_read(build_snapshot, fn, *args).addBoth(snapshot_built, key)
+    else:
+        snapshot_waiters[key].append(d)
+    return d
+
+# Runs on a reader thread. The compressed form is built here too when a
+# connection can use it, so the reactor never spends time compressing the
+# largest payload it sends.
+def build_snapshot(db, fn, *args):
+    payload = fn(db, *args)
+    if zlib_connections == 0 or len(payload) < COMPRESSION_THRESHOLD:
+        return payload, None, 0.0
+    start = time.thread_time()
+    compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+    return payload, compressed, time.thread_time() - start
+
+def snapshot_built(result, key):
+    global snapshot_compress_time
+    waiters = snapshot_waiters.pop(key)
+
+    if isinstance(result, failure.Failure):
+        for d in waiters:
+            d.errback(result)
+        return
+
+    result, compressed, elapsed = result
+    snapshot_compress_time += elapsed
+    if compressed is not None:
+        compressed_snapshots[key] = (result, compressed)
+
+    # A commit may have landed while building. The snapshot is still
+    # consistent for the waiters, but only cache it if it is current.
+    (version,) = struct.unpack_from("!Q", result)
+    if version == data_version:
+        snapshot_cache[key] = (version, result)
+    for d in waiters:
+        d.callback(result)
+
+def start_database_threads():
+    global writer, reader_pool
+    writer = DatabaseWriter()
+    writer.start()
+    reader_pool = threadpool.ThreadPool(0, READER_THREADS, "DatabaseReader")
+    reader_pool.start()
+    reactor.addSystemEventTrigger("before", "shutdown", reader_pool.stop)
+    reactor.addSystemEventTrigger("before", "shutdown", writer.stop)
     
 
+# Responses to commands, built from the command function's result.
+def respond_finished(result):
+    return MSG_FINISHED, b""
+def respond_snapshot(snapshot):
+    return MSG_SNAPSHOT, snapshot
+def respond_tournament(snapshot):
+    return MSG_TOURNAMENT, snapshot
+def respond_ids(first):
+    return MSG_IDS, str(first).encode()
+def respond_sync(result):
+    return result # sync_since already picked the message type.
+
+OPTIONAL_INT = (int, type(None))
+
+# Every command a client may send, as
+#     name : (runner, function, argument types, response)
+# The arguments are checked against the types before anything runs.
+# function(db, *arguments) is run by run_read or run_write and its result
+# is turned into the response message.
+COMMANDS = {
+    "fetchall"          : (run_cached_snapshot, fetchall,          (),                          respond_snapshot),
+    "fetch_shared"      : (run_cached_snapshot, fetch_shared,      (OPTIONAL_INT,),             respond_snapshot),
+    "fetch_tournament"  : (run_cached_snapshot, fetch_tournament,  (int,),                      respond_tournament),
+    "fetch_since"       : (run_read,            sync_since,        (int, OPTIONAL_INT),         respond_sync),
+    "allocate"          : (run_write,           allocate_ids,      (str, int),                  respond_ids),
+    "create_tournament" : (run_write,           create_tournament, (int, str, int),             respond_finished),
+    "create_player"     : (run_write,           create_player,     (int, str, int),             respond_finished),
+    "delete_tournament" : (run_write,           delete_tournament, (int,),                      respond_finished),
+    "delete_player"     : (run_write,           delete_player,     (int,),                      respond_finished),
+    "set_score"         : (run_write,           set_score,         (int, int, int),             respond_finished),
+    "set_scores"        : (run_write,           set_scores,        (list,),                     respond_finished),
+    "set_match_player"  : (run_write,           set_match_player,  (int, int, OPTIONAL_INT),    respond_finished),
+    "rename_tournament" : (run_write,           rename_tournament, (int, str),                  respond_finished),
+    "rename_player"     : (run_write,           rename_player,     (int, str),                  respond_finished),
+    "set_player_skill"  : (run_write,           set_player_skill,  (int, int),                  respond_finished),
+}
+
+# Number of calls and total time spent in each command's function.
+command_stats = collections.defaultdict(lambda : [ 0, 0.0 ])
+command_stats_lock = threading.Lock()
+
+def timed_command(name, fn):
+    @functools.wraps(fn)
+    def run(db, *args):
+        start = time.perf_counter()
+        try:
+            return fn(db, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with command_stats_lock:
+                stats = command_stats[name]
+                stats[0] += 1
+                stats[1] += elapsed
+    return run
+
+def command_stats_report():
+    with command_stats_lock:
+        report = { name : { "count" : count,
+                            "total_ms" : total * 1000,
+                            "mean_us" : total / count * 1000000 }
+                   for name, (count, total) in command_stats.items() }
+    report["snapshot_cache"] = { "hits" : snapshot_cache_hits,
+                                 "compress_ms" : snapshot_compress_time * 1000 }
+    return report
+
+def print_command_stats():
+    report = command_stats_report()
+    cache = report.pop("snapshot_cache")
+    print(f"Snapshot cache hits: {cache['hits']}")
+    print(f"Snapshot compression: {cache['compress_ms']:.1f} ms CPU on reader threads")
+    for name, stats in sorted(report.items()):
+        print(f"{name:>18}: {stats['count']:8} calls {stats['mean_us']:10.1f} us/call")
+
+def check_arguments(name, args, types):
+    if len(args) != len(types):
+        raise ValueError(f"{name} takes {len(types)} arguments, got {len(args)}.")
+    for i, (arg, arg_type) in enumerate(zip(args, types)):
+        # bool is a subclass of int but never a valid argument.
+        if isinstance(arg, bool) or not isinstance(arg, arg_type):
+            raise ValueError(f"Argument {i + 1} of {name} has the wrong type.")
+
 class SimpleServer(protocol.Protocol):
     def connectionMade(self):
         print("Client has connected to the server.")
         print(self.transport.getHost())
+        self.decoder = FrameDecoder()
+        self.compression = None # Chosen by the hello command.
+        self.bytes_payload = 0 # Payload bytes before compression.
+        self.bytes_sent = 0 # Payload bytes actually sent.
+        self.compress_time = 0.0 # CPU seconds spent compressing.
 
     def connectionLost(self, reason):
+        global zlib_connections
         print("Lost connection with client.")
+        subscribers.pop(self, None)
+        if self.compression == "zlib":
+            zlib_connections -= 1
+        if self.compression is not None and self.bytes_payload > 0:
+            saved = self.bytes_payload - self.bytes_sent
+            print(f"Compression saved {saved} of {self.bytes_payload} bytes "
+                  f"({saved / self.bytes_payload:.0%}) using {self.compress_time * 1000:.1f} ms CPU.")
+            # Shared by every connection, so not part of the figure above.
+            print(f"Snapshots compressed on reader threads so far: "
+                  f"{snapshot_compress_time * 1000:.1f} ms CPU.")
+
+    def send(self, msg_type, request_id, payload = b""):
+        self.bytes_payload += len(payload)
+        if self.compression == "zlib" and len(payload) >= COMPRESSION_THRESHOLD:
+            compressed = next((c for p, c in compressed_snapshots.values() if p is payload), None)
+            if compressed is None:
+                start = time.thread_time()
+                compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+                self.compress_time += time.thread_time() - start
+                # A snapshot built before any zlib connection existed is
+                # compressed once here and shared from then on.
+                key = next((k for k, (v, p) in snapshot_cache.items() if p is payload), None)
+                if key is not None:
+                    compressed_snapshots[key] = (payload, compressed)
+            if len(compressed) < len(payload):
+                msg_type |= FLAG_COMPRESSED
+                payload = compressed
+        self.bytes_sent += len(payload)
+        self.transport.write(encode_frame(msg_type, request_id, payload))
         
     def dataReceived(self, data):
-        # Process inputs, get outputs.
-        "As soon as any data is received, write it back."
-        s = data.decode()
-        if s == "fetchall":
-            self.transport.write(str(fetchall()).encode())
-        elif s[:6] == "create":
-            split = s.split('|')
-            if split[1] == "tournament":
-                create_tournament(int(split[2]), split[3], int(split[4]))
-                self.transport.write("Finished".encode())
-            elif split[1] == "player":
-                create_player(int(split[2]), split[3], int(split[4]))
-                self.transport.write("Finished".encode())
-        elif s[:6] == "delete":
-            split = s.split('|')
-            if split[1] == "tournament":
-                delete_tournament(int(split[2]))
-                self.transport.write("Finished".encode())
-            elif split[1] == "player":
-                delete_player(int(split[2]))
-                self.transport.write("Finished".encode())
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as e:
+            print(f"Dropping client: {e}")
+            self.transport.loseConnection()
+            return
+
+        for msg_type, request_id, payload in frames:
+            if msg_type != MSG_COMMAND:
+                self.send(MSG_ERROR, request_id, f"Unexpected message type {msg_type}".encode())
+                continue
+            d = defer.maybeDeferred(self.commandReceived, request_id, payload)
+            d.addErrback(self.commandFailed, request_id)
+
+    def sendResponse(self, result, request_id, respond):
+        msg_type, payload = respond(result)
+        self.send(msg_type, request_id, payload)
+
+    def commandFailed(self, reason, request_id):
+        print(f"Command failed: {reason.getErrorMessage()}")
+        self.send(MSG_ERROR, request_id, reason.getErrorMessage().encode())
+
+    # Process inputs. Database work is handed to the reader pool or the
+    # writer thread and the response is sent when its Deferred fires, so
+    # this returns straight away.
+    def commandReceived(self, request_id, payload):
+        global zlib_connections
+        # Decoded here so invalid UTF-8 is answered with an error like
+        # any other bad command.
+        command = json.loads(payload.decode())
+        if not isinstance(command, list) or not command or not isinstance(command[0], str):
+            raise ValueError("Commands are a JSON list starting with the command name.")
+        name, args = command[0], command[1:]
+
+        if name == "hello":
+            # Pick the first scheme from our list the client also supports.
+            check_arguments(name, args, (list,))
+            if self.compression == "zlib":
+                zlib_connections -= 1
+            self.compression = next((c for c in COMPRESSION_SCHEMES if c in args[0]), None)
+            if self.compression == "zlib":
+                zlib_connections += 1
+            self.send(MSG_HELLO, request_id, json.dumps({ "compression" : self.compression }).encode())
+        elif name == "subscribe":
+            # A t_id only pushes changes for that tournament, None for all.
+            check_arguments(name, args, (OPTIONAL_INT,))
+            subscribers[self] = args[0]
+            self.send(MSG_FINISHED, request_id)
+        elif name == "unsubscribe":
+            check_arguments(name, args, ())
+            subscribers.pop(self, None)
+            self.send(MSG_FINISHED, request_id)
+        elif name == "stats":
+            check_arguments(name, args, ())
+            self.send(MSG_STATS, request_id, json.dumps(command_stats_report()).encode())
+        elif name in COMMANDS:
+            runner, fn, types, respond = COMMANDS[name]
+            check_arguments(name, args, types)
+            d = runner(timed_command(name, fn), *args)
+            d.addCallback(self.sendResponse, request_id, respond)
+            return d
         else:
-            # This means it will be a database instruction.
-            cur = db.cursor()
-            cur.execute(s)
-            db.commit()
-            # print("PROCESSED:", s)
+            raise ValueError(f"Unknown command {name}.")
 
 def network_init():
     try:
@@ -389,11 +1138,13 @@ def network_init():
 if __name__ == "__main__":
     network_init()
     init() # Set up database if necessary.
+    start_database_threads()
     
     # This runs the protocol on specified port
     factory = protocol.ServerFactory() # Basic server factory.
     factory.protocol = SimpleServer
     
+    reactor.addSystemEventTrigger("after", "shutdown", print_command_stats)
     reactor.listenTCP(port, factory)
     print(f"Listening on port {port}.")
     print("Ctrl + C to terminate.")
@@ -6,13 +6,22 @@
 #     December 27th, 2023
 
 import sys
+import json
+import time
 import random
+import struct
 import threading
+import zlib
+import itertools
+import collections
+import bisect
+from array import array
 from PySide6 import QtCore
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import *
 from PySide6.QtGui import *
-from twisted.internet import protocol, reactor
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python.failure import Failure
 
 # Gloal constants
 
@@ -25,58 +34,777 @@ port = None
 
 # Global Objects
 app = None
+signals = None
 simple_client = None
-connection_failed = False
+# Only changed on the GUI thread. Calls made while it is False fail at once
+# instead of being queued to a reactor that may have stopped.
+server_connected = False
 database = None
+database_version = 0
+# Changes pushed by the server, kept so they can be replayed on top of a
+# snapshot that was read before them but arrived after them.
+recent_changes = collections.deque(maxlen = 10000)
 current_tournament_id = None
-finished = None
-rcv_string = ""
+# Only one tournament's matches, games and tree are kept in database, the
+# one being viewed. Tournaments and players are always loaded in full.
+loaded_tournament_id = None
+next_request_id = 1
+# Deferreds of the commands waiting for a response, by request id. Any
+# number of commands may be in flight and the server answers each one as
+# soon as it completes, so responses can arrive in any order.
+pending_requests = dict()
+
+# Message framing.
+# Every message sent between the client and the server is a frame made of
+# a fixed size header followed by the payload:
+#     [ payload length : 4 bytes ][ message type : 1 byte ][ request id : 4 bytes ]
+# All header fields are unsigned big endian integers. The request id of a
+# command is echoed back in the response to that command.
+FRAME_HEADER = struct.Struct("!IBI")
+MAX_FRAME_LENGTH = 1 << 28 # 256 MiB, anything larger is a corrupt stream.
+
+MSG_COMMAND = 1  # Client -> Server, JSON [ name, arguments... ].
+MSG_FINISHED = 2 # Server -> Client, command has been completed.
+MSG_SNAPSHOT = 3 # Server -> Client, binary fetchall snapshot.
+MSG_ERROR = 4    # Server -> Client, command failed, payload is the reason.
+MSG_DELTA = 5    # Server -> Client, JSON list of changes, see apply_changes().
+MSG_IDS = 6      # Server -> Client, first id of an allocated range as text.
+MSG_HELLO = 8    # Server -> Client, JSON of the options chosen by hello.
+MSG_TOURNAMENT = 9 # Server -> Client, binary snapshot of a single tournament.
+
+# Set in the message type of a frame whose payload is zlib compressed. The
+# server only compresses after hello() agreed on it, see db/server.py.
+FLAG_COMPRESSED = 0x80
+COMPRESSION_SCHEMES = [ "zlib" ]
+
+# Request id of changes the server pushes to subscribed clients.
+PUSH_REQUEST_ID = 0
+
+def encode_frame(msg_type, request_id, payload):
+    return FRAME_HEADER.pack(len(payload), msg_type, request_id) + payload
+
+# Incremental frame decoder. Bytes are fed in exactly as TCP hands them
+# over and complete frames are returned as soon as they are available.
+# Each byte is copied into the buffer once and sliced out once, so a large
+# payload split over many chunks is still decoded in linear time.
+# Compressed payloads are inflated chunk by chunk while they arrive, so a
+# large snapshot is ready almost as soon as its last byte is received.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.inflate = None # zlib decompressobj of a partly received frame.
+        self.inflated = list() # Output of self.inflate so far.
+        self.consumed = 0 # Payload bytes already fed to self.inflate.
+        self.bytes_compressed = 0
+        self.bytes_inflated = 0
+        self.inflate_time = 0.0 # CPU seconds spent decompressing.
+
+    def inflate_payload(self, data):
+        if self.inflate is None:
+            self.inflate = zlib.decompressobj()
+        start = time.thread_time()
+        try:
+            self.inflated.append(self.inflate.decompress(data))
+        except zlib.error as e:
+            raise ValueError(f"Bad compressed payload: {e}")
+        self.inflate_time += time.thread_time() - start
+        self.consumed += len(data)
+
+    # Returns a list of (msg_type, request_id, payload) tuples.
+    def feed(self, data):
+        self.buffer += data
+        frames = list()
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            length, msg_type, request_id = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_LENGTH:
+                raise ValueError(f"Frame length {length} exceeds maximum.")
+            start = offset + FRAME_HEADER.size
+            end = start + length
+            if msg_type & FLAG_COMPRESSED:
+                # Inflate whatever part of the payload has arrived.
+                self.inflate_payload(self.buffer[start + self.consumed:end])
+            if len(self.buffer) < end:
+                break # Wait for the rest of the payload.
+            if msg_type & FLAG_COMPRESSED:
+                payload = b"".join(self.inflated) + self.inflate.flush()
+                if not self.inflate.eof:
+                    raise ValueError("Truncated compressed payload.")
+                self.bytes_compressed += length
+                self.bytes_inflated += len(payload)
+                self.inflate = None
+                self.inflated = list()
+                self.consumed = 0
+                msg_type &= ~FLAG_COMPRESSED
+            else:
+                payload = bytes(self.buffer[start:end])
+            frames.append((msg_type, request_id, payload))
+            offset = end
+        # Deleting from the front of a bytearray does not move the data.
+        del self.buffer[:offset]
+        return frames
+
+# END class FrameDecoder
+
+# Layout of the binary fetchall snapshot, see fetchall() in db/server.py.
+# Column kinds: 'i' integer, 'n' nullable integer (-1 is NULL), 's' string
+# table index. Must match SNAPSHOT_TABLES in db/server.py.
+SNAPSHOT_TABLES = (
+    ("TT", "isis"),
+    ("MT", "iinn"),
+    ("GT", "iiii"),
+    ("PT", "nsi"),
+    ("BT", "iii"),
+)
+SNAPSHOT_TYPECODES = { 'i' : 'q', 'n' : 'q', 's' : 'I' }
+
+# One row of a ColumnTable. Reads and writes go straight to the table's
+# columns, so it behaves like the list rows of the other tables:
+# row[1] += 1, a, b = row, row == [ ... ].
+class ColumnRow:
+    __slots__ = ("table", "row_id")
+
+    def __init__(self, table, row_id):
+        self.table = table
+        self.row_id = row_id
+
+    def __getitem__(self, i):
+        return self.table.get_value(self.row_id, i)
+
+    def __setitem__(self, i, value):
+        self.table.set_value(self.row_id, i, value)
+
+    def __len__(self):
+        return len(self.table.kinds)
+
+    def __iter__(self):
+        return iter(self.table.row(self.row_id))
+
+    def __eq__(self, other):
+        return self.table.row(self.row_id) == list(other)
+
+    def __repr__(self):
+        return repr(self.table.row(self.row_id))
+
+# END class ColumnRow
+
+# Table of integer rows stored column by column in typed arrays, 8 bytes
+# a value instead of a list and an int object per value. Used for the
+# matches, games and match tree, the tables that grow with every
+# tournament. Behaves like the { row_id : [ values... ] } dicts used for
+# the other tables. Kinds are those of SNAPSHOT_TABLES without the id
+# column; NULL is stored as -1 like in snapshots.
+# Rows are addressed directly by row_id - base, so lookups cost no more
+# than in a dict and no per row index is kept. The server hands out ids
+# in ranges, one per tournament, so the ids of the loaded rows are nearly
+# contiguous and the span between them costs little.
+class ColumnTable:
+    def __init__(self, kinds, ids = (), columns = None):
+        self.kinds = kinds
+        self.base = 0 # row_id of the first entry in the columns.
+        self.columns = [ array('q') for kind in kinds ]
+        self.present = bytearray() # 1 for entries that hold a row.
+        self.count = 0
+        if columns is not None and len(ids) > 0:
+            if all(b == a + 1 for a, b in zip(ids, ids[1:])):
+                # Contiguous, the usual case, the arrays are used as they are.
+                self.base = ids[0]
+                self.columns = columns
+                self.present = bytearray(b"\x01") * len(ids)
+                self.count = len(ids)
+            else:
+                for row_id, row in zip(ids, zip(*columns)):
+                    self[row_id] = row
+
+    def position(self, row_id):
+        i = row_id - self.base
+        if 0 <= i < len(self.present) and self.present[i]:
+            return i
+        raise KeyError(row_id)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, row_id):
+        i = row_id - self.base
+        return 0 <= i < len(self.present) and self.present[i] == 1
+
+    def __iter__(self):
+        return itertools.compress(range(self.base, self.base + len(self.present)), self.present)
+
+    def __getitem__(self, row_id):
+        self.position(row_id)
+        return ColumnRow(self, row_id)
+
+    def get(self, row_id, default = None):
+        if row_id not in self:
+            return default
+        return ColumnRow(self, row_id)
+
+    def items(self):
+        for row_id in self:
+            yield row_id, ColumnRow(self, row_id)
+
+    def values(self):
+        for row_id in self:
+            yield ColumnRow(self, row_id)
+
+    def get_value(self, row_id, i):
+        value = self.columns[i][self.position(row_id)]
+        if value == -1 and self.kinds[i] == 'n':
+            return None
+        return value
+
+    def set_value(self, row_id, i, value):
+        self.columns[i][self.position(row_id)] = -1 if value is None else value
+
+    # The row's values as a list.
+    def row(self, row_id):
+        return [ self.get_value(row_id, i) for i in range(len(self.kinds)) ]
+
+    # Grow the columns so they cover row_id.
+    def reserve(self, row_id):
+        if self.count == 0:
+            self.base = row_id
+            self.columns = [ array('q', [ 0 ]) for kind in self.kinds ]
+            self.present = bytearray(1)
+        elif row_id < self.base:
+            gap = self.base - row_id
+            self.columns = [ array('q', [ 0 ]) * gap + column for column in self.columns ]
+            self.present[:0] = bytes(gap)
+            self.base = row_id
+        elif row_id >= self.base + len(self.present):
+            gap = row_id - self.base - len(self.present) + 1
+            for column in self.columns:
+                column.extend(array('q', [ 0 ]) * gap)
+            self.present.extend(bytes(gap))
+
+    def __setitem__(self, row_id, row):
+        if row_id not in self:
+            self.reserve(row_id)
+            self.present[row_id - self.base] = 1
+            self.count += 1
+        i = row_id - self.base
+        for column, value in zip(self.columns, row):
+            column[i] = -1 if value is None else value
+
+    # Removes the row and returns its values as a list.
+    def pop(self, row_id):
+        row = self.row(row_id)
+        self.present[row_id - self.base] = 0
+        self.count -= 1
+        return row
+
+    def __delitem__(self, row_id):
+        self.pop(row_id)
+
+# END class ColumnTable
+
+# Rebuild the database dictionary from a snapshot. Every column is read
+# with a single array.frombytes(), integer tables keep those arrays as
+# their storage and the other rows are zipped back together. Nothing in
+# the payload is evaluated as python source.
+# Returns the data version of the snapshot and the database dictionary.
+def decode_snapshot(payload):
+    view = memoryview(payload)
+    version, length = struct.unpack_from("!QI", view, 0)
+    offset = 12
+    strings = str(view[offset:offset + length], "utf-8").split("\0")
+    offset += length
+
+    ret = dict()
+    for key, kinds in SNAPSHOT_TABLES:
+        (rows,) = struct.unpack_from("!I", view, offset)
+        offset += 4
+        columns = list()
+        for kind in kinds:
+            col = array(SNAPSHOT_TYPECODES[kind])
+            size = col.itemsize * rows
+            col.frombytes(view[offset:offset + size])
+            offset += size
+            if sys.byteorder == "big":
+                col.byteswap()
+
+            if kind == 's':
+                columns.append(list(map(strings.__getitem__, col)))
+            elif kind == 'n' and -1 in col and 's' in kinds:
+                columns.append([ None if v == -1 else v for v in col ])
+            else:
+                columns.append(col)
+
+        if 's' in kinds:
+            ret[key] = dict(zip(columns[0], map(list, zip(*columns[1:]))))
+        else:
+            ret[key] = ColumnTable(kinds[1:], columns[0], columns[1:])
+
+    return version, ret
+
+# Secondary indexes over database, so lookups never scan a whole table.
+# Each maps the first column of a table to the ids of the rows holding that
+# value, as a dict used as an ordered set (rows keep database order). They
+# are only changed through set_row(), delete_row() and index_database().
+tournament_names = dict()   # name -> { t_id }
+player_names = dict()       # name -> { p_id }
+tournament_matches = dict() # t_id -> { m_id }
+match_games = dict()        # m_id -> { g_id }
+INDEXES = {
+    "TT" : tournament_names,
+    "PT" : player_names,
+    "MT" : tournament_matches,
+    "GT" : match_games,
+}
+# Every player as player_sort_key() tuples kept in order, for the name
+# ordered player lists and prefix search.
+player_order = list()
+
+def player_sort_key(p_id, row):
+    return (row[0].casefold(), -1 if p_id is None else p_id)
+
+def index_row(key, row_id, row):
+    index = INDEXES.get(key)
+    if index is not None:
+        index.setdefault(row[0], dict())[row_id] = None
+    if key == "PT":
+        bisect.insort(player_order, player_sort_key(row_id, row))
+
+def unindex_row(key, row_id, row):
+    index = INDEXES.get(key)
+    if index is not None:
+        ids = index[row[0]]
+        del ids[row_id]
+        if not ids:
+            del index[row[0]]
+    if key == "PT":
+        del player_order[bisect.bisect_left(player_order, player_sort_key(row_id, row))]
+
+def index_table(key):
+    index = INDEXES[key]
+    index.clear()
+    for row_id, row in database[key].items():
+        index.setdefault(row[0], dict())[row_id] = None
+    if key == "PT":
+        player_order[:] = sorted(player_sort_key(p_id, row) for p_id, row in database["PT"].items())
+
+# Rebuild every index after database has been replaced.
+def index_database():
+    for key in INDEXES:
+        index_table(key)
+
+# Insert or replace a row, keeping the indexes up to date.
+def set_row(key, row_id, row):
+    table = database[key]
+    old = table.get(row_id)
+    if old is None:
+        index_row(key, row_id, row)
+    elif old[0] != row[0]:
+        unindex_row(key, row_id, old)
+        index_row(key, row_id, row)
+    table[row_id] = row
+
+def delete_row(key, row_id):
+    unindex_row(key, row_id, database[key].pop(row_id))
+
+# Change one column of a row in place, for edits made locally.
+def set_column(key, row_id, column, value):
+    row = database[key][row_id]
+    if column == 0:
+        unindex_row(key, row_id, row)
+        row[0] = value
+        index_row(key, row_id, row)
+    else:
+        row[column] = value
+
+# Whether a row belongs in the local database. Matches, games and tree
+# edges of tournaments other than the loaded one are left on the server.
+def in_loaded_tournament(key, row_id, row):
+    if key == "MT":
+        return row[0] == loaded_tournament_id
+    elif key == "GT":
+        return row[0] in database["MT"]
+    elif key == "BT":
+        return row_id in database["MT"]
+    return True
+
+# Apply changes from a fetch_since response or a server push to the local
+# database. Each change is [ version, key, op, row_id, values... ] where op
+# is 'I'nsert, 'U'pdate or 'D'elete and values are the whole row after the
+# change. Changes up to version since (default database_version) are
+# skipped, and changes to rows with local edits in pending_rows are kept in
+# deferred_changes until the edits are answered. Returns the set of table
+# keys whose contents actually changed.
+def apply_changes(changes, since = None):
+    if since is None:
+        since = database_version
+    changed = set()
+    for change in changes:
+        if change[0] <= since:
+            continue
+        key = change[1]
+        if (key, change[3]) in pending_rows:
+            deferred_changes[(key, change[3])] = change
+            continue
+        table = database[key]
+        if change[2] == 'D':
+            if change[3] in table:
+                delete_row(key, change[3])
+                changed.add(key)
+        else:
+            row = list(change[4:])
+            if not in_loaded_tournament(key, change[3], row):
+                continue
+            if table.get(change[3]) != row:
+                set_row(key, change[3], row)
+                changed.add(key)
+    return changed
+
+# Replace the loaded tournament with a fetch_tournament snapshot. The
+# snapshot may be older than pushes already received, so those are
+# replayed on top of it.
+def merge_tournament(t_id, version, snapshot):
+    global loaded_tournament_id
+    loaded_tournament_id = t_id
+    for key in ("MT", "GT", "BT"):
+        database[key] = snapshot[key]
+    index_table("MT")
+    index_table("GT")
+    for key in ("TT", "PT"):
+        for row_id, row in snapshot[key].items():
+            set_row(key, row_id, row)
+    apply_changes(recent_changes, since = version)
+
+# What the server sent is decoded on the reactor thread and handed to these
+# through signals.gui_call, so database, its indexes and database_version
+# are only ever changed on the GUI thread. Qt runs them in the order they
+# were emitted, which is the order the frames arrived in, and before the
+# done callbacks of call_server() for the same responses.
+def snapshot_received(version, snapshot):
+    global database
+    global database_version
+    database_version = version
+    database = snapshot
+    index_database()
+    apply_changes(recent_changes)
+    if recent_changes:
+        database_version = max(database_version, recent_changes[-1][0])
+    player_list.refresh()
+
+def delta_received(delta):
+    global database_version
+    apply_changes(delta["changes"])
+    database_version = max(database_version, delta["version"])
+
+def delta_pushed(delta):
+    global database_version
+    recent_changes.extend(delta["changes"])
+    if database is None:
+        return # Replayed once the snapshot arrives.
+    # Another client changed something.
+    changed = apply_changes(delta["changes"])
+    database_version = max(database_version, delta["version"])
+    if changed:
+        signals.database_changed.emit(changed)
+
+def tournament_loaded(t_id, version, snapshot):
+    merge_tournament(t_id, version, snapshot)
+    player_list.refresh()
+
+# Signals emitted from the reactor thread. Qt queues them to the GUI thread,
+# so the slots can safely touch widgets.
+class ClientSignals(QtCore.QObject):
+    # Set of table keys changed by a server push.
+    database_changed = QtCore.Signal(object)
+    # The connection to the server was made, or could not be made.
+    connected = QtCore.Signal()
+    connection_failed = QtCore.Signal()
+    # The connection was lost and the reactor stopped.
+    connection_lost = QtCore.Signal()
+    # Description of the server calls in flight, empty when idle.
+    busy_changed = QtCore.Signal(str)
+    # Function to run on the GUI thread, see call_server().
+    gui_call = QtCore.Signal(object)
+    # A local edit was undone because the server did not apply it.
+    edit_rolled_back = QtCore.Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.calls = list() # Messages of the calls in flight.
+        self.gui_call.connect(self.run_gui_call)
+
+    def run_gui_call(self, fn):
+        fn()
+
+    def call_started(self, message):
+        self.calls.append(message)
+        self.busy_changed.emit(", ".join(self.calls))
+
+    def call_ended(self, message, done, result):
+        # Calls are dropped by abandon_calls() when the connection is lost.
+        if message in self.calls:
+            self.calls.remove(message)
+            self.busy_changed.emit(", ".join(self.calls))
+        if done is not None:
+            done(result)
+
+    # The reactor has stopped, calls still in flight will never end.
+    def abandon_calls(self):
+        self.calls.clear()
+        self.busy_changed.emit("")
+
+# END class ClientSignals
+
+# A command failed on the server, or the connection was lost before the
+# response arrived.
+class CommandError(Exception):
+    pass
 
 # Networking functions.
-def close_connection():
-    simple_client.transport.loseConnection()
-def fetchall():
-    global rcv_string
-    rcv_string = ""
-    simple_client.transport.write(b"fetchall")
-def db_instruction(ins):
-    simple_client.transport.write(ins.encode())
+# These must be called from the reactor thread (reactor.callFromThread).
+def close_connection(connector):
+    if simple_client is not None:
+        simple_client.transport.loseConnection()
+    elif connector.state == "connecting":
+        # Closed before the connection was made, giving up the attempt
+        # stops the reactor through clientConnectionFailed().
+        connector.stopConnecting()
+# Commands are typed: a name and a fixed list of int, str or None
+# arguments, see COMMANDS in db/server.py. Returns a Deferred that fires
+# with the response, see SimpleClient.responseReceived().
+def send_command(name, *args):
+    global next_request_id
+    if simple_client is None:
+        print(f"Not connected, {name} not sent.")
+        raise CommandError("Not connected.")
+    request_id = next_request_id
+    # Request id 0 is never used so it can mean "no request".
+    next_request_id = (next_request_id + 1) & 0xFFFFFFFF or 1
+    command = json.dumps([ name, *args ]).encode()
+    # Cancelling, as a timeout does, forgets the request so a late response
+    # is ignored.
+    d = pending_requests[request_id] = defer.Deferred(lambda d : pending_requests.pop(request_id, None))
+    simple_client.transport.write(encode_frame(MSG_COMMAND, request_id, command))
+    return d
+# Tell the server which compression schemes we can decode.
+def hello():
+    return send_command("hello", COMPRESSION_SCHEMES).addCallback(hello_received)
+def hello_received(options):
+    print(f"Compression: {options['compression']}")
+def fetch_shared():
+    return send_command("fetch_shared", loaded_tournament_id)
+def fetch_tournament(t_id):
+    return send_command("fetch_tournament", t_id).addCallback(tournament_received, t_id)
+def tournament_received(payload, t_id):
+    start = time.perf_counter()
+    version, snapshot = decode_snapshot(payload)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"Tournament {t_id}: {len(payload)} bytes decoded in {elapsed:.1f} ms")
+    signals.gui_call.emit(lambda : tournament_loaded(t_id, version, snapshot))
+def fetch_since():
+    return send_command("fetch_since", database_version, loaded_tournament_id)
+# Pushes are limited to tournament t_id, or every tournament for None.
+def subscribe(t_id = None):
+    return send_command("subscribe", t_id)
+def allocate_ids(table, count):
+    return send_command("allocate", table, count)
+
+# For commands sent alongside the one waited for. Their errors were already
+# printed, and a lost connection fails the other one too.
+def ignore_failure(reason):
+    return None
+
+# Everything needed at startup, sent without waiting in between. Returns
+# the Deferred of the snapshot.
+def start_session():
+    hello().addErrback(ignore_failure)
+    subscribe().addErrback(ignore_failure)
+    return fetch_shared()
+
+# The server handles subscribe as soon as it arrives, before the snapshot
+# is read, so every change after the snapshot is pushed to us.
+def switch_tournament(t_id):
+    subscribe(t_id).addErrback(ignore_failure)
+    return fetch_tournament(t_id)
+
+# Writes can finish after reads sent later, so the sync is only sent once
+# the command has completed.
+def send_and_sync(name, *args):
+    return send_command(name, *args).addCallback(lambda result : fetch_since())
+
+# Create a row with an id allocated by the server, so two clients can
+# never pick the same one. The command takes the new id as its first
+# argument. Returns a Deferred firing with the new id once it is synced.
+def create_with_new_id(table, name, *args):
+    d = allocate_ids(table, 1)
+    d.addCallback(lambda new_id : send_and_sync(name, new_id, *args)
+                                  .addCallback(lambda result : new_id))
+    return d
+
+# Called from the GUI thread. Runs fn on the reactor thread and, once the
+# Deferred it returns fires, calls done(result) back on the GUI thread.
+# done is not called if the command failed. message is shown in the main
+# window's status bar meanwhile, the GUI never waits on the server.
+def call_server(message, fn, *args, done = None):
+    if not server_connected:
+        print(f"Not connected to the server, {message} failed.")
+        return
+    signals.call_started(message)
+
+    def succeeded(result):
+        signals.gui_call.emit(lambda : signals.call_ended(message, done, result))
+
+    def failed(reason):
+        if not reason.check(CommandError): # Already printed otherwise.
+            reason.printTraceback()
+        signals.gui_call.emit(lambda : signals.call_ended(message, None, None))
+
+    reactor.callFromThread(lambda : defer.maybeDeferred(fn, *args).addCallbacks(succeeded, failed))
+
+# Edits made from the GUI are applied to database at once, and the command
+# making them on the server is sent without waiting. The edited rows are
+# counted in pending_rows until the server answers the command, and the
+# server's changes to them, including the push of the edit itself, wait in
+# deferred_changes meanwhile so they do not overwrite edits made since. The
+# last of them is applied once the row has no edits left unanswered. If an
+# edit fails, or is not answered within EDIT_TIMEOUT seconds, it is undone
+# and the views redrawn. The row as the server last confirmed it is kept in
+# confirmed_rows while it has edits unanswered, so stacked edits that all
+# fail go back to it rather than to a value the server never had. Commands
+# whose results come from the server, such as created rows or cascading
+# deletes, still use send_and_sync().
+EDIT_TIMEOUT = 10
+pending_rows = collections.Counter() # (key, row_id) -> unanswered edits
+deferred_changes = dict() # (key, row_id) -> last change from the server
+confirmed_rows = dict() # (key, row_id) -> row before its unanswered edits
+failed_rows = set() # (key, row_id) with an edit that failed
+unanswered_edits = dict() # id(undo) -> (undo, name) of edits sent
+
+# Called from the GUI thread. Sets each (key, row_id, column, value) and
+# returns the edits, to be passed to edit_finished() once answered.
+def apply_edit(columns):
+    undo = list()
+    for key, row_id, column, value in columns:
+        if (key, row_id) not in pending_rows:
+            confirmed_rows[(key, row_id)] = list(database[key][row_id])
+        undo.append((key, row_id, column, value))
+        set_column(key, row_id, column, value)
+        pending_rows[(key, row_id)] += 1
+    return undo
+
+# Called from the GUI thread. Sends the command for edits already applied.
+def send_edit(undo, name, *args):
+    def acknowledged(result):
+        signals.gui_call.emit(lambda : edit_finished(undo, name, None))
+
+    def failed(reason):
+        signals.gui_call.emit(lambda : edit_finished(undo, name, reason))
+
+    unanswered_edits[id(undo)] = (undo, name)
+    if not server_connected:
+        # Undone once the caller has finished showing the edit.
+        reason = Failure(CommandError("Not connected to the server."))
+        QtCore.QTimer.singleShot(0, lambda : edit_finished(undo, name, reason))
+        return
+    reactor.callFromThread(lambda : defer.maybeDeferred(send_command, name, *args)
+                                    .addTimeout(EDIT_TIMEOUT, reactor)
+                                    .addCallbacks(acknowledged, failed))
+
+def optimistic_edit(columns, name, *args):
+    send_edit(apply_edit(columns), name, *args)
+
+# Called on the GUI thread once the server answered, reason is the
+# failure if there was one.
+def edit_finished(undo, name, reason):
+    # Edits are failed by fail_unanswered_edits() when the connection is
+    # lost, an answer arriving after that is ignored.
+    if unanswered_edits.pop(id(undo), None) is None:
+        return
+    changed = set()
+    for key, row_id, column, value in reversed(undo):
+        row_key = (key, row_id)
+        confirmed = confirmed_rows[row_key]
+        if reason is not None:
+            failed_rows.add(row_key)
+            # Only undo columns still holding this edit's value, a later
+            # edit is newer.
+            if row_id in database[key] and database[key][row_id][column] == value:
+                set_column(key, row_id, column, confirmed[column])
+                changed.add(key)
+        pending_rows[row_key] -= 1
+        if pending_rows[row_key]:
+            continue
+        del pending_rows[row_key]
+        del confirmed_rows[row_key]
+        # The server's version of the row replaces the local one. Without
+        # one, a row with a failed edit goes back to what it confirmed.
+        change = deferred_changes.pop(row_key, None)
+        if change is not None:
+            changed |= apply_changes([ change ], since = -1)
+        elif row_key in failed_rows and row_id in database[key] and database[key][row_id] != confirmed:
+            set_row(key, row_id, confirmed)
+            changed.add(key)
+        failed_rows.discard(row_key)
+
+    if reason is not None:
+        if reason.check(defer.TimeoutError):
+            print(f"No answer to {name}, undone.")
+        elif not reason.check(CommandError): # Already printed otherwise.
+            reason.printTraceback()
+        signals.edit_rolled_back.emit(f"{name} failed, the change was undone.")
+    if changed:
+        signals.database_changed.emit(changed)
+
+# Called on the GUI thread once the reactor has stopped. Edits it was
+# given but never ran would otherwise be held in pending_rows forever.
+def fail_unanswered_edits():
+    for undo, name in list(unanswered_edits.values()):
+        edit_finished(undo, name, Failure(CommandError("Connection lost.")))
+
+# Load a tournament's matches, games and tree in place of the previously
+# loaded one, then call done on the GUI thread.
+def load_tournament(t_id, done):
+    if t_id is None or t_id == loaded_tournament_id:
+        done(None)
+    else:
+        call_server("Loading tournament", switch_tournament, t_id, done = done)
 
 
 # Functions for fetching information from the database dictionary
 def tournament_numplayers(t_id):
     return database["TT"][t_id][1]
 
+# Players of the first round, the matches that are not a parent in the tree.
 def tournament_player_id_list(t_id):
     ret = list()
     
-    for m_id in database["MT"]:
-        if m_id not in database["BT"] and database["MT"][m_id][0] == t_id:
+    for m_id in tournament_matches.get(t_id, ()):
+        if m_id not in database["BT"]:
             ret.append(database["MT"][m_id][1])
             ret.append(database["MT"][m_id][2])
 
     return ret
 
 def tournament_match_id_list(t_id):
+    return list(tournament_matches.get(t_id, ()))
+
+# Returns (parent_id, l_child_id, r_child_id) for every edge of the tree.
+def tournament_tree_edges(t_id):
     ret = list()
 
-    for m_id in database["MT"]:
-        if database["MT"][m_id][0] == t_id:
-            ret.append(m_id)
-    
+    for m_id in tournament_matches.get(t_id, ()):
+        if m_id in database["BT"]:
+            ret.append((m_id, *database["BT"][m_id]))
+
     return ret
 
+def match_game_id_list(m_id):
+    return list(match_games.get(m_id, ()))
+
+# Names are unique when created from this client, but not enforced by the
+# server, the first match is returned.
 def tournament_name_to_id(name):
-    for t_id in database["TT"]:
-        if database["TT"][t_id][0] == name:
-            return t_id
-    return None
+    return next(iter(tournament_names.get(name, ())), None)
 
 def player_name_to_id(name):
-    for p_id in database["PT"]:
-        if database["PT"][p_id][0] == name:
-            return p_id
-    return None
+    return next(iter(player_names.get(name, ())), None)
 
 # Function used to truncate user names for rectangles.
 # This can still lead to them sticking outside of the
@@ -88,6 +816,50 @@ def shorten_name(name):
     else:
         return name[0]
 
+# List model of every player in name order, one instance shared by the
+# player selection widgets. Rows are read from player_order, which the
+# indexes keep sorted, so the model itself holds nothing per player.
+class PlayerListModel(QtCore.QAbstractListModel):
+    def rowCount(self, parent = QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(player_order)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
+        return database["PT"][self.player_id(index.row())][0]
+
+    def player_id(self, row):
+        p_id = player_order[row][1]
+        return None if p_id == -1 else p_id
+
+    def player_row(self, p_id):
+        return bisect.bisect_left(player_order, player_sort_key(p_id, database["PT"][p_id]))
+
+    # Players were added, removed or renamed.
+    def refresh(self):
+        self.beginResetModel()
+        self.endResetModel()
+
+# END class PlayerListModel
+
+player_list = None # PlayerListModel, created with the main window.
+
+# Combo box choosing from every player, with prefix search by name. The
+# completer relies on the model being sorted and searches by bisection.
+def player_combo_box():
+    combo = QComboBox()
+    combo.setEditable(True)
+    combo.setInsertPolicy(QComboBox.NoInsert)
+    # Size the box and its popup without measuring every player.
+    combo.setSizeAdjustPolicy(QComboBox.AdjustToMinimumContentsLengthWithIcon)
+    combo.setMinimumContentsLength(16)
+    combo.view().setUniformItemSizes(True)
+    combo.view().setLayoutMode(QListView.Batched)
+    combo.setModel(player_list)
+    combo.completer().setCaseSensitivity(Qt.CaseInsensitive)
+    combo.completer().setModelSorting(QCompleter.CaseInsensitivelySortedModel)
+    return combo
+
 # Window created to allow for a user to delete a player when
 # selected in the main window's action bar.
 class PlayerDeletionWindow(QWidget):
@@ -97,14 +869,14 @@ class PlayerDeletionWindow(QWidget):
         self.setLayout(QVBoxLayout())
         self.layout = self.layout()
         self.name_label = QLabel("Players:")
-        self.name_list = QListWidget()
+        self.name_list = QListView()
+        self.name_list.setUniformItemSizes(True)
+        self.name_list.setLayoutMode(QListView.Batched)
+        self.name_list.setModel(player_list)
+        self.name_list.setRowHidden(player_list.player_row(None), True) # Cannot delete null player.
         self.delete_button = QPushButton("Delete")
         self.delete_button.clicked.connect(self.delete_tournament)
-        self.name_list.itemPressed.connect(self.list_selection_changed)
-
-        for p_id in database["PT"]:
-            if database["PT"][p_id][0] != "N/A": # Cannot delete null player.
-                self.name_list.addItem(database["PT"][p_id][0])
+        self.name_list.pressed.connect(self.list_selection_changed)
         
         self.layout.addWidget(self.name_label)
         self.layout.addWidget(self.name_list)
@@ -118,30 +890,19 @@ class PlayerDeletionWindow(QWidget):
 
         self.selected_id = None
 
-    def list_selection_changed(self, item):
-        self.selected_id = player_name_to_id(item.text())
+    def list_selection_changed(self, index):
+        self.selected_id = player_list.player_id(index.row())
         
     def delete_tournament(self):
-        global database
-
         if self.selected_id is None:
             return
         
-        # Separation using pipes so I can do split() with '|'
-        ins = f"delete|player|{self.selected_id}"
-        global finished
-        finished = False
-        reactor.callFromThread(db_instruction, ins)
-        
-        while not finished: #Wait for database to finish setting up tournament.
-            pass
-        
-        # Re-acquire database with fetchall
-        database = None
-        reactor.callFromThread(fetchall)
-        while database is None:
-            pass
+        # Pull only the rows that changed once the command has completed.
+        call_server("Deleting player", send_and_sync, "delete_player", self.selected_id,
+                    done = self.player_deleted)
 
+    def player_deleted(self, result):
+        player_list.refresh()
         # Update the tournament widget if necessary
         if self.parent.t_widget is not None:
             self.parent.t_widget.setup_graphics()
@@ -149,7 +910,7 @@ class PlayerDeletionWindow(QWidget):
 
         # Otherwise update the player widget.
         elif self.parent.p_widget is not None:
-            self.parent.set_central_widget_players()
+            self.parent.p_widget.refresh()
             
         # Close self and tell parent that it closed
         self.parent.temp_window = None
@@ -192,9 +953,8 @@ class PlayerCreationWindow(QWidget):
         if name == "":
             return
 
-        for p_id in database["PT"]:
-            if database["PT"][p_id][0] == name:
-                return
+        if name in player_names:
+            return
 
         # Invalid skill level check
         try:
@@ -202,28 +962,15 @@ class PlayerCreationWindow(QWidget):
         except ValueError:
             return
 
-        # Pull an unused player id
-        p_ids = set(database["PT"].keys())
-        new_id = 0
-        while new_id in p_ids:
-            new_id += 1
-
-        # Separation using pipes so I can do split() with '|'
-        ins = f"create|player|{new_id}|{name}|{skill}|"
-        global finished
-        finished = False
-        reactor.callFromThread(db_instruction, ins)
-        
-        while not finished: #Wait for database to finish setting up player.
-            pass
-        
-        # Put information into local database, getting whole database
-        # back for creating a single player is not necessary.
-        database["PT"][new_id] = [ name, skill ]
+        # The new player is pulled in by fetch_since once it is created.
+        call_server("Creating player", create_with_new_id, "players", "create_player", name, skill,
+                    done = self.player_created)
 
+    def player_created(self, new_id):
+        player_list.refresh()
         # Update the player widget if necessary
         if self.parent.p_widget is not None:
-            self.parent.set_central_widget_players()
+            self.parent.p_widget.refresh()
 
         # Close self and tell parent that it closed
         self.parent.temp_window = None
@@ -264,26 +1011,14 @@ class TournamentDeletionWindow(QWidget):
         self.selected_id = tournament_name_to_id(item.text())
         
     def delete_tournament(self):
-        global database
-
         if self.selected_id is None:
             return
         
-        # Separation using pipes so I can do split() with '|'
-        ins = f"delete|tournament|{self.selected_id}"
-        global finished
-        finished = False
-        reactor.callFromThread(db_instruction, ins)
-        
-        while not finished: #Wait for database to finish setting up tournament.
-            pass
-        
-        # Re-acquire database with fetchall
-        database = None
-        reactor.callFromThread(fetchall)
-        while database is None:
-            pass
+        # Pull only the rows that changed once the command has completed.
+        call_server("Deleting tournament", send_and_sync, "delete_tournament", self.selected_id,
+                    done = self.tournament_deleted)
 
+    def tournament_deleted(self, result):
         # Update the tournament widget if necessary
         if self.parent.t_widget is not None:
             self.parent.t_widget.setup_graphics()
@@ -331,36 +1066,19 @@ class TournamentCreationWindow(QWidget):
         if name == "":
             return
 
-        for t_id in database["TT"]:
-            if database["TT"][t_id][0] == name:
-                return
+        if name in tournament_names:
+            return
         
         try:
             num_players = int(self.count_entry.text())
         except ValueError:
             return
 
-        # Pull an unused tournament id
-        t_ids = set(database["TT"].keys())
-        new_id = 0
-        while new_id in t_ids:
-            new_id += 1
-
-        # Separation using pipes so I can do split() with '|'
-        ins = f"create|tournament|{new_id}|{name}|{num_players}"
-        global finished
-        finished = False
-        reactor.callFromThread(db_instruction, ins)
-        
-        while not finished: #Wait for database to finish setting up tournament.
-            pass
-        
-        # Re-acquire database with fetchall
-        database = None
-        reactor.callFromThread(fetchall)
-        while database is None:
-            pass
+        # Large brackets take a while, the status bar shows it meanwhile.
+        call_server("Creating tournament", create_with_new_id, "tournaments", "create_tournament", name, num_players,
+                    done = self.tournament_created)
 
+    def tournament_created(self, new_id):
         # Update the tournament widget if necessary
         if self.parent.t_widget is not None:
             self.parent.t_widget.setup_graphics()
@@ -375,37 +1093,61 @@ class TournamentCreationWindow(QWidget):
 # Toolbox used by the TournamentWidget when a player rectangle is selected
 # in tournament view mode.
 class PlayerToolBox(QToolBox):
-    def __init__(self, parent, p_rect, t_id):
+    def __init__(self, parent):
         super().__init__(parent = parent)
-        self.p_rect = p_rect
-        self.t_id = t_id
-        self.selection_box = QComboBox()
+        self.p_rect = None
+        self.t_id = None
+        self.selection_box = player_combo_box()
         self.m_rect = None # match rectangle this player is associated with.
-        current_index = 0
-        for i, p_id in enumerate(database["PT"]):
-            self.selection_box.addItem(database["PT"][p_id][0])
-            if p_id == p_rect.p_id:
-                current_index = i
-                
-        self.selection_box.setCurrentIndex(current_index)
         
         self.addItem(self.selection_box, "Select Player")
 
-        self.selection_box.currentTextChanged.connect(self.selection_changed)
+        # Only choices made by the user, not a refresh of the model.
+        self.selection_box.activated.connect(self.selection_changed)
 
-    def selection_changed(self, text):
-        self.p_rect.set_player(player_name_to_id(text))
+    # Show the player of p_rect.
+    def bind(self, p_rect, t_id):
+        self.p_rect = p_rect
+        self.t_id = t_id
+        self.selection_box.setCurrentIndex(player_list.player_row(p_rect.p_id))
+
+    def selection_changed(self, row):
+        self.p_rect.set_player(player_list.player_id(row))
 
 # END class PlayerToolBox
 
 
+# Score edits wait in pending_scores until no edit has been made for
+# SCORE_FLUSH_DELAY ms, or the match toolbox moves to another match, and
+# then go out together in one set_scores command.
+SCORE_FLUSH_DELAY = 500
+pending_scores = dict() # (g_id, slot) -> score
+pending_score_undo = list() # apply_edit() undo of every queued edit
+score_timer = None # QTimer calling flush_scores(), created with the main window.
+
+# Only the scores edited are sent, the other one may be changed by
+# another client meanwhile.
+def queue_score(g_id, slot, score):
+    pending_score_undo.extend(apply_edit([ ("GT", g_id, slot, score) ]))
+    pending_scores[(g_id, slot)] = score
+    score_timer.start() # Restarts the quiet period.
+
+def flush_scores():
+    if not pending_scores:
+        return
+    score_timer.stop()
+    scores = [ [ g_id, slot, score ] for (g_id, slot), score in pending_scores.items() ]
+    send_edit(list(pending_score_undo), "set_scores", scores)
+    pending_scores.clear()
+    pending_score_undo.clear()
+
 # Widget used in the MatchToolBox for each game in a given system.
 class GameWidget(QWidget):
-    def __init__(self, parent, g_id):
+    def __init__(self, parent):
         super().__init__(parent = parent)
-        self.g_id = g_id
-        self.p1_score = database["GT"][self.g_id][1]
-        self.p2_score = database["GT"][self.g_id][2]
+        self.g_id = None
+        self.p1_score = 0
+        self.p2_score = 0
         self.setLayout(QGridLayout())
         self.layout = self.layout()
         self.p1_label = QLabel(f"P1 Score: {self.p1_score}", self)
@@ -428,36 +1170,46 @@ class GameWidget(QWidget):
         self.layout.addWidget(self.p2_plus, 3, 0)
         self.layout.addWidget(self.p2_minus, 3, 1)
 
+    def send_score(self, slot):
+        queue_score(self.g_id, slot, self.p1_score if slot == 1 else self.p2_score)
+
+    # Show the scores of game g_id.
+    def bind(self, g_id):
+        self.g_id = g_id
+        self.refresh()
+
+    # Reload the scores from the database after someone else changed them.
+    def refresh(self):
+        if self.g_id not in database["GT"]:
+            return
+        # Edits not sent yet are newer than what the server has.
+        self.p1_score = pending_scores.get((self.g_id, 1), database["GT"][self.g_id][1])
+        self.p2_score = pending_scores.get((self.g_id, 2), database["GT"][self.g_id][2])
+        self.p1_label.setText(f"P1 Score: {self.p1_score}")
+        self.p2_label.setText(f"P2 Score: {self.p2_score}")
+
     def p1_plus_pressed(self):
         self.p1_score += 1
-        database["GT"][self.g_id][1] += 1
-        ins = f"UPDATE games SET p1_score = {self.p1_score} WHERE id = {self.g_id}"
-        reactor.callFromThread(db_instruction, ins)
+        self.send_score(1)
         self.p1_label.setText(f"P1 Score: {self.p1_score}")
         
     def p2_plus_pressed(self):
         self.p2_score += 1
-        database["GT"][self.g_id][2] += 1
-        ins = f"UPDATE games SET p2_score = {self.p2_score} WHERE id = {self.g_id}"
-        reactor.callFromThread(db_instruction, ins)
+        self.send_score(2)
         self.p2_label.setText(f"P2 Score: {self.p2_score}")
         
     def p1_minus_pressed(self):
         if self.p1_score == 0:
             return
         self.p1_score -= 1
-        database["GT"][self.g_id][1] -= 1
-        ins = f"UPDATE games SET p1_score = {self.p1_score} WHERE id = {self.g_id}"
-        reactor.callFromThread(db_instruction, ins)
+        self.send_score(1)
         self.p1_label.setText(f"P1 Score: {self.p1_score}")
         
     def p2_minus_pressed(self):
         if self.p2_score == 0:
             return
         self.p2_score -= 1
-        database["GT"][self.g_id][2] -= 1
-        ins = f"UPDATE games SET p2_score = {self.p2_score} WHERE id = {self.g_id}"
-        reactor.callFromThread(db_instruction, ins)
+        self.send_score(2)
         self.p2_label.setText(f"P2 Score: {self.p2_score}")
 
 # END class GameWidget
@@ -465,58 +1217,74 @@ class GameWidget(QWidget):
 
 # Toolbox used by the TournamentWidget when a match is selected.
 class MatchToolBox(QToolBox):
-    def __init__(self, parent, m_rect, t_id):
+    def __init__(self, parent):
         super().__init__(parent = parent)
-        self.m_rect = m_rect
-        self.t_id = t_id
+        self.m_rect = None
+        self.t_id = None
         self.p1_select = QComboBox()
         self.p2_select = QComboBox()
-        
+        self.p1_ids = list() # combo box row -> p_id
+        self.p2_ids = list()
+
+        self.addItem(self.p1_select, "Select Player 1")
+        self.addItem(self.p2_select, "Select Player 2")
+
+        # Only choices made by the user, not the ones made by bind().
+        self.p1_select.activated.connect(self.p1_selection_changed)
+        self.p2_select.activated.connect(self.p2_selection_changed)
+
+        # Game widgets are made as needed and kept, only the first
+        # num_games are in the toolbox.
+        self.game_tabs = list()
+        self.num_games = 0
+
+    # Show match m_rect, reusing the widgets of the previous match. Binding
+    # the match already shown again keeps the open game.
+    def bind(self, m_rect, t_id):
+        if m_rect is self.m_rect:
+            current = self.currentIndex()
+        else:
+            # Scores of the previous match go out before it is left.
+            flush_scores()
+            current = 0
+        self.m_rect = m_rect
+        self.t_id = t_id
+
         # Allow for only selection of players from
         # children matches.
         if self.m_rect.m_id in database["BT"]:
-            p1_index = 0
-            p2_index = 0
-            l_player_ids = self.__get_binary_tree_left_child_player_ids()
-            for i, p_id in enumerate(l_player_ids):
-                self.p1_select.addItem(database["PT"][p_id][0])
-                if p_id == self.m_rect.p1_id:
-                    p1_index = i
-            r_player_ids = self.__get_binary_tree_right_child_player_ids()
-            for i, p_id in enumerate(r_player_ids):
-                self.p2_select.addItem(database["PT"][p_id][0])
-                if p_id == self.m_rect.p2_id:
-                    p2_index = i
-            self.p1_select.setCurrentIndex(p1_index)
-            self.p2_select.setCurrentIndex(p2_index)
+            self.p1_ids = self.__get_binary_tree_left_child_player_ids()
+            self.p2_ids = self.__get_binary_tree_right_child_player_ids()
             
         # Do not allow for selection of players, they are
         # set by the player_rects that are associated with this
         # match rectangle.
         else:
-            self.p1_select.addItem(database["PT"][self.m_rect.p1_rect.p_id][0])
-            self.p2_select.addItem(database["PT"][self.m_rect.p2_rect.p_id][0])
-            self.p1_select.setEditable(False)
-            self.p2_select.setEditable(False)
-
-        self.addItem(self.p1_select, "Select Player 1")
-        self.addItem(self.p2_select, "Select Player 2")
-
-        self.p1_select.currentTextChanged.connect(self.p1_selection_changed)
-        self.p2_select.currentTextChanged.connect(self.p2_selection_changed)
-
-        # Set up the 7 game tabs with their respective widgets.
-        game_ids = list()
-        for g_id in database["GT"]:
-            if self.m_rect.m_id == database["GT"][g_id][0]:
-                game_ids.append(g_id)
-
-        self.game_tabs = list()
-        for g_id in game_ids:
-            self.game_tabs.append(GameWidget(self, g_id))
-
-        for i, g_widget in enumerate(self.game_tabs):
-            self.addItem(g_widget, f"Game {i + 1}")
+            self.p1_ids = [ self.m_rect.p1_rect.p_id ]
+            self.p2_ids = [ self.m_rect.p2_rect.p_id ]
+        self.set_choices(self.p1_select, self.p1_ids, self.m_rect.p1_id)
+        self.set_choices(self.p2_select, self.p2_ids, self.m_rect.p2_id)
+
+        # Set up the game tabs with their respective widgets.
+        game_ids = match_game_id_list(self.m_rect.m_id)
+        while len(self.game_tabs) < len(game_ids):
+            self.game_tabs.append(GameWidget(self))
+        while self.num_games < len(game_ids):
+            self.addItem(self.game_tabs[self.num_games], f"Game {self.num_games + 1}")
+            self.num_games += 1
+        while self.num_games > len(game_ids):
+            self.num_games -= 1
+            self.removeItem(self.count() - 1)
+
+        for g_widget, g_id in zip(self.game_tabs, game_ids):
+            g_widget.bind(g_id)
+        self.setCurrentIndex(min(current, self.count() - 1))
+
+    def set_choices(self, combo_box, p_ids, current):
+        combo_box.clear()
+        for p_id in p_ids:
+            combo_box.addItem(database["PT"][p_id][0])
+        combo_box.setCurrentIndex(p_ids.index(current) if current in p_ids else 0)
 
     def __get_binary_tree_left_child_player_ids(self):
         ret = list()
@@ -536,10 +1304,14 @@ class MatchToolBox(QToolBox):
         
         return ret
 
-    def p1_selection_changed(self, text):
-        self.m_rect.set_player1(player_name_to_id(text))
-    def p2_selection_changed(self, text):
-        self.m_rect.set_player2(player_name_to_id(text))
+    def refresh_scores(self):
+        for g_widget in self.game_tabs[:self.num_games]:
+            g_widget.refresh()
+
+    def p1_selection_changed(self, row):
+        self.m_rect.set_player1(self.p1_ids[row])
+    def p2_selection_changed(self, row):
+        self.m_rect.set_player2(self.p2_ids[row])
 
 # END class MatchToolBox
 
@@ -557,17 +1329,27 @@ class TournamentRenameWidget(QWidget):
         self.layout = self.layout()
 
         self.selected_id = None
-        for t_id in database["TT"]:
-            self.selection_list.addItem(database["TT"][t_id][0])
+        self.t_ids = list() # list row -> t_id
         self.selection_list.itemPressed.connect(self.list_selection_changed)
         self.line_edit.editingFinished.connect(self.edit_tournament_name)
 
         self.layout.addWidget(self.selection_list)
         self.layout.addWidget(self.label)
         self.layout.addWidget(self.line_edit)
+        self.refresh()
+
+    # Reload the tournament names, keeping the selection if it still exists.
+    def refresh(self):
+        self.t_ids = list(database["TT"])
+        self.selection_list.clear()
+        for t_id in self.t_ids:
+            self.selection_list.addItem(database["TT"][t_id][0])
+        if self.selected_id not in database["TT"]:
+            self.selected_id = None
+            self.line_edit.clear()
         
     def list_selection_changed(self, item):
-        selected_id = tournament_name_to_id(item.text())
+        selected_id = self.t_ids[self.selection_list.row(item)]
         if selected_id == self.selected_id:
             return
         self.selected_id = selected_id
@@ -579,10 +1361,9 @@ class TournamentRenameWidget(QWidget):
         
         new_name = self.line_edit.text()
 
-        self.selection_list.item(self.selected_id).setText(new_name)
-        database["TT"][self.selected_id][0] = new_name
-        ins = f"UPDATE tournaments SET name = '{new_name}' WHERE id = {self.selected_id}"
-        reactor.callFromThread(db_instruction, ins)
+        self.selection_list.item(self.t_ids.index(self.selected_id)).setText(new_name)
+        optimistic_edit([ ("TT", self.selected_id, 0, new_name) ],
+                        "rename_tournament", self.selected_id, new_name)
 
         # Update the tournament name in the selection list in
         # the parent toolbox.
@@ -597,34 +1378,38 @@ class TournamentSelectionWidget(QWidget):
         super().__init__(parent = parent)
         self.parent = parent
         self.t_id = t_id
+        self.t_ids = list() # combo box row -> t_id
         self.setLayout(QVBoxLayout())
         self.layout = self.layout()
         self.selection_box = QComboBox()
         self.date_label = QLabel()
+        # Only choices made by the user, not the ones made by setup_widgets().
+        self.selection_box.activated.connect(self.tournament_selection_changed)
+        self.layout.addWidget(self.selection_box)
+        self.layout.addWidget(self.date_label)
         self.setup_widgets()
 
     def setup_widgets(self): 
-        current_index = 0
-        current_date = "N/A"
+        self.t_ids = [ None ]
+        self.t_ids.extend(database["TT"])
+        self.selection_box.clear()
         self.selection_box.addItem("None")
-        for i, t_id in enumerate(database["TT"]):
+        for t_id in self.t_ids[1:]:
             self.selection_box.addItem(database["TT"][t_id][0])
-            if t_id == self.t_id:
-                current_index = i + 1
-                current_date = database["TT"][t_id][2]
-        self.selection_box.setCurrentIndex(current_index)
-        self.date_label.setText(f"Date: {current_date}")
-            
-        self.selection_box.currentTextChanged.connect(self.tournament_selection_changed)
-        self.layout.addWidget(self.selection_box)
-        self.layout.addWidget(self.date_label)
-        
-    def tournament_selection_changed(self, text):
-        self.t_id = tournament_name_to_id(text)
+        if self.t_id not in database["TT"]:
+            self.t_id = None
+        self.selection_box.setCurrentIndex(self.t_ids.index(self.t_id))
+        self.show_date()
+
+    def show_date(self):
         if self.t_id is None:
             self.date_label.setText("Date: N/A")
         else:
             self.date_label.setText(f'Date: {database["TT"][self.t_id][2]}')
+        
+    def tournament_selection_changed(self, row):
+        self.t_id = self.t_ids[row]
+        self.show_date()
         self.parent.tournament_selection_changed(self.t_id)
         
 # END class TournamentRenameWidget
@@ -635,39 +1420,75 @@ class TournamentSelectionWidget(QWidget):
 class TournamentToolBox(QToolBox):
     def __init__(self, parent, t_id):
         super().__init__(parent = parent)
+        self.t_widget = parent
         self.t_id = t_id
-        self.selection_widget = None
-        self.setup_selection_widget()
+        self.selection_widget = TournamentSelectionWidget(self, self.t_id)
+        self.addItem(self.selection_widget, "Select Tournament")
         self.rename_widget = TournamentRenameWidget(self)
         self.addItem(self.rename_widget, "Rename Tournanents")
+
+    # Show tournament t_id, with the tournament list reloaded.
+    def bind(self, t_id):
+        self.t_id = t_id
+        self.setup_selection_widget()
+        self.rename_widget.refresh()
         
     def setup_selection_widget(self):
-        old = None
-        if self.selection_widget is not None:
-            old = self.selection_widget
-            
-        selection_widget = TournamentSelectionWidget(self, self.t_id)
-
-        if old is None:
-            self.selection_widget = selection_widget
-            self.addItem(self.selection_widget, "Select Tournament")
-        else:
-            self.removeItem(0)
-            old.close()
-            self.selection_widget = selection_widget
-            self.insertItem(0, self.selection_widget, "Select Tournament")
+        self.selection_widget.t_id = self.t_id
+        self.selection_widget.setup_widgets()
         
     def tournament_selection_changed(self, t_id):
         global current_tournament_id
         current_tournament_id = t_id
         self.t_id = t_id
-        self.parent().update_tournament()
+        t_widget = self.t_widget
+        load_tournament(t_id, lambda result : t_widget.update_tournament())
 
 # END class TournamentToolBox
 
 
+# Brush of the rectangle under the mouse.
+HOVER_BRUSH = QBrush(QColor(200, 220, 255))
+# Space between a rectangle and its label.
+TEXT_MARGIN = 4
+# Labels are unreadable below this zoom and are hidden.
+TEXT_MIN_SCALE = 0.4
+# Connector lines are batched into one path item per round and band of
+# this many pixels, so off screen bands are still culled.
+CONNECTOR_BAND = 1200
+# Zoom factor per wheel step and the zoom limits.
+ZOOM_STEP = 1.25
+MIN_ZOOM = 0.02
+MAX_ZOOM = 4.0
+
+# Rectangle item that carries the id of what it shows. The scene finds the
+# rectangle under a click with itemAt(), which uses the scene's BSP index
+# instead of testing every rectangle, and hover highlighting comes from
+# Qt's own hover events.
+class BracketRect(QGraphicsRectItem):
+    def __init__(self, x, y, w, h, graphics_scene):
+        super().__init__(QtCore.QRectF(x, y, w, h))
+        self.gs = graphics_scene
+        self.setAcceptHoverEvents(True)
+        # The label is a child so it moves and is removed with the rectangle.
+        self.text = QGraphicsSimpleTextItem(self)
+        self.text.setPos(x + TEXT_MARGIN, y + TEXT_MARGIN)
+        # Labels only change with a name, draw them from a cached pixmap.
+        self.text.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+
+    def hoverEnterEvent(self, event):
+        self.setBrush(HOVER_BRUSH)
+
+    def hoverLeaveEvent(self, event):
+        self.setBrush(QBrush())
+
+    def add_to_scene(self):
+        self.gs.addItem(self)
+
+# END class BracketRect
+
 # Rectanle representing matches on the graphics scene.
-class MatchRect:
+class MatchRect(BracketRect):
     def __init__(self,
                  x, y, w, h,
                  m_id, graphics_scene,
@@ -675,70 +1496,68 @@ class MatchRect:
         # If the player rects are None, then this match is on the
         # binary tree and the players need to be grabbed from
         # the matches it originates from.
-        
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
-        self.gs = graphics_scene
+        super().__init__(x, y, w, h, graphics_scene)
         self.m_id = m_id
         self.p1_rect = p1_rect
         self.p2_rect = p2_rect
         
         self.p1_id = database["MT"][self.m_id][1]
         self.p2_id = database["MT"][self.m_id][2]
+        self.label = None
+        self.update_text()
 
-    def add_to_scene(self):
-        self.rect = self.gs.addRect(QtCore.QRectF(self.x, self.y, self.w, self.h))
+    def update_text(self):
         string = shorten_name(database["PT"][self.p1_id][0]) + " V.S. " + shorten_name(database["PT"][self.p2_id][0])
-        self.text = self.gs.addText(string)
-        self.text.setPos(self.x, self.y)
+        # Relaying out the text is the expensive part, skip it if unchanged.
+        if string != self.label:
+            self.label = string
+            self.text.setText(string)
+
+    # Show the players the database has for this match, after a change
+    # made elsewhere.
+    def refresh(self):
+        self.p1_id = database["MT"][self.m_id][1]
+        self.p2_id = database["MT"][self.m_id][2]
+        self.update_text()
 
     def set_player1(self, p_id):
         self.p1_id = p_id
-        database["MT"][self.m_id][1] = p_id
-        ins = f"UPDATE matches SET p1_id = {p_id} WHERE id = {self.m_id}"
-        reactor.callFromThread(db_instruction, ins)
-        string = shorten_name(database["PT"][self.p1_id][0]) + " V.S. " + shorten_name(database["PT"][self.p2_id][0])
-        self.text.setPlainText(string)
+        optimistic_edit([ ("MT", self.m_id, 1, p_id) ], "set_match_player", self.m_id, 1, p_id)
+        self.update_text()
 
     def set_player2(self, p_id):
         self.p2_id = p_id
-        database["MT"][self.m_id][2] = p_id
-        ins = f"UPDATE matches SET p2_id = {p_id} WHERE id = {self.m_id}"
-        reactor.callFromThread(db_instruction, ins)
-        string = shorten_name(database["PT"][self.p1_id][0]) + " V.S. " + shorten_name(database["PT"][self.p2_id][0])
-        self.text.setPlainText(string)
+        optimistic_edit([ ("MT", self.m_id, 2, p_id) ], "set_match_player", self.m_id, 2, p_id)
+        self.update_text()
 
 # END class MatchRect
 
 # Player rectangle objects to represent players on the
 # graphics scene.
-class PlayerRect:
+class PlayerRect(BracketRect):
     def __init__(self,
                  x, y, w, h,
                  p_id, graphics_scene):
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
-        self.gs = graphics_scene
-        self.p_id = p_id
-        self.name = shorten_name(database["PT"][self.p_id][0])
+        super().__init__(x, y, w, h, graphics_scene)
+        self.p_id = None
+        self.name = None
+        self.show_player(p_id)
         self.m_rect = None # match rectangle this player is associated with.
 
-    def add_to_scene(self):
-        self.rect = self.gs.addRect(QtCore.QRectF(self.x, self.y, self.w, self.h))
-        self.text = self.gs.addText(self.name)
-        self.text.setPos(self.x, self.y)
+    # Show a player without changing the match, after a change made
+    # elsewhere.
+    def show_player(self, p_id):
+        name = shorten_name(database["PT"][p_id][0])
+        self.p_id = p_id
+        if name != self.name:
+            self.name = name
+            self.text.setText(self.name)
 
     def set_player(self, p_id):
         # Only perform changes if necessary
         if p_id != self.p_id:
             old = self.p_id
-            self.p_id = p_id
-            self.name = shorten_name(database["PT"][self.p_id][0])
-            self.text.setPlainText(self.name)
+            self.show_player(p_id)
             # Edit the match player selection list.
             if self.m_rect.p1_id == old:
                 self.m_rect.set_player1(p_id)
@@ -751,39 +1570,153 @@ class PlayerRect:
 # END class PlayerRect
 
 # Graphics scene which will keep track of all rectangles and their connections
-# on the display.
+# on the display. One scene is built per tournament and kept in
+# scene_cache, so switching back to a tournament reuses its layout.
 class TournamentGraphicsScene(QGraphicsScene):
-    def __init__(self, parent):
-        super().__init__(parent = parent)
+    def __init__(self, t_id):
+        super().__init__()
         #self.setAcceptedMouseButtons(Qt.LeftButton)
-        self.p_rects = None
-        self.m_rects = None
+        self.t_id = t_id
+        self.widget = None # TournamentWidget showing the scene.
+        self.player_rects = list()
+        self.match_rects = list()
+        self.scene_rect = QtCore.QRectF(0, 0, 800, 800)
+        self.connectors = dict() # (round x, band) -> QPainterPath
+        self.detail = True # labels shown
         self.is_clicked = False
         self.selected = None
-        
-    def set_player_rects(self, p_rects):
-        self.p_rects = p_rects
+        if t_id is not None:
+            self.build()
+
+    # Adds a connector to the path of its round and band, the paths are
+    # added to the scene at the end of build().
+    def draw_lines_to_gs(self, x0, y0, x1, y1):
+        key = (x1, int(y1 // CONNECTOR_BAND))
+        path = self.connectors.get(key)
+        if path is None:
+            path = self.connectors[key] = QPainterPath()
+        path.moveTo(x0, y0)
+        path.lineTo(x0 + (x1 - x0) / 2, y0)
+        path.lineTo(x0 + (x1 - x0) / 2, y1)
+        path.lineTo(x1, y1)
+        return
+
+    # Connect the right side of one rectangle to the left side of another.
+    def draw_lines_between(self, from_rect, to_rect):
+        a = from_rect.rect()
+        b = to_rect.rect()
+        self.draw_lines_to_gs(a.right(), a.center().y(), b.left(), b.center().y())
+
+    # Lay out the bracket of tournament t_id.
+    def build(self):
+        # Add player rectangles
+        self.player_rects = list()
+        pos_x = 50
+        pos_y = 20
+        w = 100
+        h = 30
+        for i, p_id in enumerate(tournament_player_id_list(self.t_id)):
+            self.player_rects.append(PlayerRect(pos_x, pos_y + i * 60, w, h, p_id, self))
+
+        for p_rect in self.player_rects:
+            p_rect.add_to_scene()
+
+        # Add match rectangles.
+        self.match_rects = list()
+        pos_x += w + 40
+        start_y = 20 + h # starting position of player rects plus the height of the rects.
+        pos_y = start_y
+        w += 120
+        # Height (h) remains 30.
+        n = len(self.player_rects) // 2
+        first_matches = True
+        j = 0
+        mult = 1
+        match_rect_dict = dict()
+        num_odds = 0
+        for i, m_id in enumerate(tournament_match_id_list(self.t_id)):
+            if (first_matches):
+                self.match_rects.append(MatchRect(pos_x, pos_y,
+                                                  w, h, m_id, self,
+                                                  self.player_rects[i * 2],
+                                                  self.player_rects[i * 2 + 1]))
+                self.player_rects[i * 2].set_match_rect(self.match_rects[-1])
+                self.player_rects[i * 2 + 1].set_match_rect(self.match_rects[-1])
+                # Draw lines between players and match rectangles.
+                self.draw_lines_between(self.player_rects[i * 2], self.match_rects[-1])
+                self.draw_lines_between(self.player_rects[i * 2 + 1], self.match_rects[-1])
+            else:
+                self.match_rects.append(MatchRect(pos_x, pos_y,
+                                                  w, h, m_id, self))
+                
+            # Save the match rectangles for drawing later with the match tree.
+            match_rect_dict[m_id] = self.match_rects[-1]
+
+            if (j == n - 1):
+                num_odds += n % 2
+                pos_x += w + 40
+                start_y += 60 * mult
+                pos_y = start_y
+                n = n // 2
+                if num_odds == 2:
+                    num_odds = 0
+                    n += 1
+                if n == 0:
+                    n = 1
+                first_matches = False
+                j = 0
+                mult *= 2
+            else:
+                pos_y += 120 * mult # move down based on what column the rectangle is in
+                j += 1
 
-    def set_match_rects(self, m_rects):
-        self.m_rects = m_rects
+        # Draw lines between matches
+        for parent_id, l_id, r_id in tournament_tree_edges(self.t_id):
+            self.draw_lines_between(match_rect_dict[l_id], match_rect_dict[parent_id])
+            self.draw_lines_between(match_rect_dict[r_id], match_rect_dict[parent_id])
+        
+        for m_rect in self.match_rects:
+            m_rect.add_to_scene()
+
+        for path in self.connectors.values():
+            self.addPath(path)
+        self.connectors = dict()
+
+        # Make sure all objects are visible.
+        self.scene_rect = QtCore.QRectF(0, 0, pos_x, len(self.player_rects) * 60 + 40)
+
+    # Labels are hidden when the view is zoomed out below TEXT_MIN_SCALE.
+    def set_scale(self, scale):
+        detail = scale >= TEXT_MIN_SCALE
+        if detail != self.detail:
+            self.detail = detail
+            for rect in itertools.chain(self.player_rects, self.match_rects):
+                rect.text.setVisible(detail)
+
+    # Bring the labels up to date with the database, touching only the
+    # ones that changed. Returns False if the bracket itself changed, in
+    # which case the scene has to be built again.
+    def refresh(self):
+        if self.t_id not in database["TT"]:
+            return False
+        if tournament_match_id_list(self.t_id) != [ m_rect.m_id for m_rect in self.match_rects ]:
+            return False
+        for p_rect, p_id in zip(self.player_rects, tournament_player_id_list(self.t_id)):
+            p_rect.show_player(p_id)
+        for m_rect in self.match_rects:
+            m_rect.refresh()
+        return True
 
     def mousePressEvent(self, event):
-        self.selected = None
         self.is_clicked = True
-        if self.p_rects is not None:
-            for p_rect in self.p_rects:
-                if p_rect.rect.contains(event.scenePos()):
-                    self.selected = p_rect
-                    break
-            
-            # if player rects exist, the match rects also exist.
-            if self.selected is None:
-                for m_rect in self.m_rects:
-                    if m_rect.rect.contains(event.scenePos()):
-                        self.selected = m_rect
-                        break
+        # The topmost item may be a label or a line, select the rectangle
+        # it belongs to, if any.
+        item = self.itemAt(event.scenePos(), QTransform())
+        while item is not None and not isinstance(item, BracketRect):
+            item = item.parentItem()
+        self.selected = item
 
-        app.sendEvent(self.parent(), event)
+        app.sendEvent(self.widget, event)
 
     def mouseReleaseEvent(self, event):
         self.is_clicked = False
@@ -791,6 +1724,49 @@ class TournamentGraphicsScene(QGraphicsScene):
 # END class TournamentGraphicsScene
 
 
+# View of a bracket, zoomed with the mouse wheel while control is held.
+class BracketView(QGraphicsView):
+    def __init__(self):
+        super().__init__()
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setOptimizationFlags(QGraphicsView.DontSavePainterState
+                                  | QGraphicsView.DontAdjustForAntialiasing)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+
+    def zoom(self):
+        return self.transform().m11()
+
+    def zoom_to(self, scale):
+        scale = min(max(scale, MIN_ZOOM), MAX_ZOOM)
+        factor = scale / self.zoom()
+        self.scale(factor, factor)
+        if self.scene() is not None:
+            self.scene().set_scale(scale)
+
+    def wheelEvent(self, event):
+        if event.modifiers() & Qt.ControlModifier:
+            self.zoom_to(self.zoom() * ZOOM_STEP ** (event.angleDelta().y() / 120))
+        else:
+            super().wheelEvent(event)
+
+# END class BracketView
+
+# Scenes of recently viewed tournaments, least recently viewed first.
+SCENE_CACHE_SIZE = 8
+scene_cache = collections.OrderedDict() # t_id -> TournamentGraphicsScene
+
+# Returns an up to date scene for tournament t_id.
+def scene_for_tournament(t_id):
+    if t_id is None:
+        return TournamentGraphicsScene(None)
+    scene = scene_cache.pop(t_id, None)
+    if scene is None or not scene.refresh():
+        scene = TournamentGraphicsScene(t_id)
+    scene_cache[t_id] = scene
+    while len(scene_cache) > SCENE_CACHE_SIZE:
+        scene_cache.popitem(last = False)
+    return scene
+
 # Class for the main widget of the tournament mode. Will consist
 # of 3 widgets, a QGraphicsScene, a QGraphicsView, and a custom
 # QToolBox depending on the type of object selected on the
@@ -798,170 +1774,98 @@ class TournamentGraphicsScene(QGraphicsScene):
 class TournamentWidget(QWidget):
     def __init__(self, parent, t_id):
         super().__init__(parent=parent)
-        self.gv = None
+        self.gv = BracketView()
         self.gs = None
-        self.tb = None
         self.t_id = t_id
         self.setLayout(QHBoxLayout())
         self.layout = self.layout()
+        # Add the view to the layout
+        self.layout.addWidget(self.gv)
+        # Widget 0 has stretch factor of 4.
+        self.layout.setStretch(0, 4)
+
+        # One of each toolbox is made and rebound to whatever is selected,
+        # the stack shows the one in use.
+        self.tournament_tb = TournamentToolBox(self, self.t_id)
+        self.player_tb = PlayerToolBox(self)
+        self.match_tb = MatchToolBox(self)
+        self.tb_stack = QStackedWidget()
+        for tb in (self.tournament_tb, self.player_tb, self.match_tb):
+            self.tb_stack.addWidget(tb)
+        self.tb = self.tournament_tb
+        self.layout.addWidget(self.tb_stack)
+        # Widget 1 has stretch factor of 1.
+        self.layout.setStretch(1, 1)
 
         self.setup_graphics()
-        self.setup_tournament_toolbox()
 
-    def draw_lines_to_gs(self, x0, y0, x1, y1):
-        self.gs.addLine(QtCore.QLineF(x0, y0, x0 + (x1 - x0) / 2, y0))
-        self.gs.addLine(QtCore.QLineF(x0 + (x1 - x0) / 2, y0, x0 + (x1 - x0) / 2, y1))
-        self.gs.addLine(QtCore.QLineF(x0 + (x1 - x0) / 2, y1, x1, y1))
-        return
-        
+    # Show the scene of self.t_id. The scene is reused from scene_cache and
+    # brought up to date when possible, and only built when it is new or
+    # its bracket changed.
     def setup_graphics(self):
-        # Create the widgets
-        prev = self.gv
-        self.gv = QGraphicsView()
-        self.gs = TournamentGraphicsScene(self)
-
-        # Set the viewing scene
-        self.gv.setSceneRect(0, 0, 800, 800)
-        self.gv.setScene(self.gs)
-
-        if self.t_id != None:
-            # Add player rectangles
-            self.player_rects = list()
-            pos_x = 50
-            pos_y = 20
-            w = 100
-            h = 30
-            for i, p_id in enumerate(tournament_player_id_list(self.t_id)):
-                self.player_rects.append(PlayerRect(pos_x, pos_y + i * 60, w, h, p_id, self.gs))
-
-            self.gs.set_player_rects(self.player_rects)
-            for p_rect in self.player_rects:
-                p_rect.add_to_scene()
-
-            # Add match rectangles.
-            self.match_rects = list()
-            pos_x += w + 40
-            start_y = 20 + h # starting position of player rects plus the height of the rects.
-            pos_y = start_y
-            w += 120
-            # Height (h) remains 30.
-            n = len(self.player_rects) // 2
-            first_matches = True
-            j = 0
-            mult = 1
-            match_rect_dict = dict()
-            num_odds = 0
-            for i, m_id in enumerate(tournament_match_id_list(self.t_id)):
-                if (first_matches):
-                    self.match_rects.append(MatchRect(pos_x, pos_y,
-                                                      w, h, m_id, self.gs,
-                                                      self.player_rects[i * 2],
-                                                      self.player_rects[i * 2 + 1]))
-                    self.player_rects[i * 2].set_match_rect(self.match_rects[-1])
-                    self.player_rects[i * 2 + 1].set_match_rect(self.match_rects[-1])
-                    # Draw lines between players and match rectangles.
-                    self.draw_lines_to_gs(self.player_rects[i * 2].x + self.player_rects[i * 2].w,
-                                          self.player_rects[i * 2].y + self.player_rects[i * 2].h / 2,
-                                          self.match_rects[-1].x,
-                                          self.match_rects[-1].y + self.match_rects[-1].h / 2)
-                    self.draw_lines_to_gs(self.player_rects[i * 2 + 1].x + self.player_rects[i * 2 + 1].w,
-                                          self.player_rects[i * 2 + 1].y + self.player_rects[i * 2 + 1].h / 2,
-                                          self.match_rects[-1].x,
-                                          self.match_rects[-1].y + self.match_rects[-1].h / 2)
-                else:
-                    self.match_rects.append(MatchRect(pos_x, pos_y,
-                                                      w, h, m_id, self.gs))
-                    
-                # Save the match rectangles for drawing later with the match tree.
-                match_rect_dict[m_id] = self.match_rects[-1]
-
-                if (j == n - 1):
-                    num_odds += n % 2
-                    pos_x += w + 40
-                    start_y += 60 * mult
-                    pos_y = start_y
-                    n = n // 2
-                    if num_odds == 2:
-                        num_odds = 0
-                        n += 1
-                    if n == 0:
-                        n = 1
-                    first_matches = False
-                    j = 0
-                    mult *= 2
-                else:
-                    pos_y += 120 * mult # move down based on what column the rectangle is in
-                    j += 1
-
-            # Draw lines between matches
-            for parent_id in database["BT"]:
-                if database["MT"][parent_id][0] == self.t_id:
-                    l_id = database["BT"][parent_id][0]
-                    r_id = database["BT"][parent_id][1]
-                    self.draw_lines_to_gs(match_rect_dict[l_id].x + match_rect_dict[l_id].w,
-                                          match_rect_dict[l_id].y + match_rect_dict[l_id].h / 2,
-                                          match_rect_dict[parent_id].x,
-                                          match_rect_dict[parent_id].y + match_rect_dict[parent_id].h / 2)
-                    self.draw_lines_to_gs(match_rect_dict[r_id].x + match_rect_dict[r_id].w,
-                                          match_rect_dict[r_id].y + match_rect_dict[r_id].h / 2,
-                                          match_rect_dict[parent_id].x,
-                                          match_rect_dict[parent_id].y + match_rect_dict[parent_id].h / 2)
-            
-            self.gs.set_match_rects(self.match_rects)
-            for m_rect in self.match_rects:
-                m_rect.add_to_scene()
-
-            # Make sure all objects are visible.
-            self.gv.setSceneRect(0, 0, pos_x, len(self.player_rects) * 60 + 40)
-
-            
-        # Set scroll bars to be at top right corner of scene.
-        self.gv.centerOn(0, 0)
-
-        if prev is None:
-            # Add the view to the layout
-            self.layout.addWidget(self.gv)
-            # Widget 0 has stretch factor of 4.
-            self.layout.setStretch(0, 4)
-        else:
-            self.layout.replaceWidget(prev, self.gv)
-            prev.close()
+        prev = self.gs
+        self.gs = scene_for_tournament(self.t_id)
+        self.gs.widget = self
+        self.gs.set_scale(self.gv.zoom())
+        self.player_rects = self.gs.player_rects
+        self.match_rects = self.gs.match_rects
+        self.gv.setSceneRect(self.gs.scene_rect)
+        if self.gs is not prev:
+            self.gv.setScene(self.gs)
+            # Set scroll bars to be at top right corner of scene.
+            self.gv.centerOn(0, 0)
+
+    def show_toolbox(self, tb):
+        self.tb = tb
+        self.tb_stack.setCurrentWidget(tb)
 
     def setup_tournament_toolbox(self):
-        prev = self.tb
-        self.tb = TournamentToolBox(self, self.t_id)
-        if prev is None:
-            self.layout.addWidget(self.tb)
-            # Widget 1 has stretch factor of 1.
-            self.layout.setStretch(1, 1)
-        else:
-            self.layout.replaceWidget(prev, self.tb)
-            prev.close()
+        self.tournament_tb.bind(self.t_id)
+        self.show_toolbox(self.tournament_tb)
 
     def mousePressEvent(self, event):
         # Event happened in graphics scene, check to see if we need
         # to change the toolbox.        if self.gs.is_clicked:
         if isinstance(self.gs.selected, PlayerRect):
-            prev = self.tb
-            self.tb = PlayerToolBox(self, self.gs.selected, self.t_id)
-            self.layout.replaceWidget(prev, self.tb)
-            prev.close()
+            self.player_tb.bind(self.gs.selected, self.t_id)
+            self.show_toolbox(self.player_tb)
 
         elif isinstance(self.gs.selected, MatchRect):
-            prev = self.tb
-            self.tb = MatchToolBox(self, self.gs.selected, self.t_id)
-            self.layout.replaceWidget(prev, self.tb)
-            prev.close()
+            self.match_tb.bind(self.gs.selected, self.t_id)
+            self.show_toolbox(self.match_tb)
 
         else:
-            prev = self.tb
-            self.tb = TournamentToolBox(self, current_tournament_id)
-            self.layout.replaceWidget(prev, self.tb)
-            prev.close()
+            self.tournament_tb.bind(current_tournament_id)
+            self.show_toolbox(self.tournament_tb)
             
         # Also check to see if the event occurred in the currently
         # active toolbox and respond accordingly.
 
+    def database_changed(self, tables):
+        global current_tournament_id
+        # Scores are not drawn on the scene, only the open toolbox needs them.
+        if tables == { "GT" }:
+            if isinstance(self.tb, MatchToolBox):
+                self.tb.refresh_scores()
+            return
+
+        # The tournament being viewed may have been deleted.
+        if self.t_id not in database["TT"]:
+            scene_cache.pop(self.t_id, None)
+            self.t_id = None
+            current_tournament_id = None
+        prev = self.gs
+        self.setup_graphics()
+        # A refreshed scene keeps its rects, so an open match or player
+        # toolbox stays on its item. A rebuilt bracket has new rects and
+        # goes back to the tournament toolbox.
+        if self.gs is prev and self.tb is self.match_tb and self.match_tb.m_rect in self.match_rects:
+            self.match_tb.bind(self.match_tb.m_rect, self.t_id)
+        elif self.gs is prev and self.tb is self.player_tb and self.player_tb.p_rect in self.player_rects:
+            self.player_tb.bind(self.player_tb.p_rect, self.t_id)
+        else:
+            self.setup_tournament_toolbox()
+
     def update_tournament(self):
         if current_tournament_id != self.t_id or True:
             self.t_id = current_tournament_id
@@ -993,15 +1897,14 @@ class PlayerEditToolBox(QToolBox):
         
         new_name = self.name_edit.text().strip()
         # No exact matching names.
-        for p_id in database["PT"]:
-            if new_name == database["PT"][p_id][0]:
-                return
+        if new_name in player_names:
+            return
         self.name = new_name
 
         # Update database
-        database["PT"][self.p_id][0] = self.name
-        ins = f"UPDATE players SET name = '{self.name}' WHERE id = {self.p_id}"
-        reactor.callFromThread(db_instruction, ins)
+        optimistic_edit([ ("PT", self.p_id, 0, self.name) ],
+                        "rename_player", self.p_id, self.name)
+        player_list.refresh()
 
         # Change table
         self.parent.edit_name(self.name)
@@ -1022,70 +1925,146 @@ class PlayerEditToolBox(QToolBox):
         self.skill = skill
 
         # Update database
-        database["PT"][self.p_id][1] = self.skill
-        ins = f"UPDATE players SET skill = {self.skill} WHERE id = {self.p_id}"
-        reactor.callFromThread(db_instruction, ins)
+        optimistic_edit([ ("PT", self.p_id, 1, self.skill) ],
+                        "set_player_skill", self.p_id, self.skill)
 
         # Change table
         self.parent.edit_skill(self.skill)
         
 # END class PlayerEditToolBox
 
+# Table model of database["PT"]. The rows are a list of player ids which
+# is sorted and filtered here rather than by a QSortFilterProxyModel, as
+# the proxy calls data() for every comparison and takes close to a minute
+# to sort 100k players.
+class PlayerTableModel(QtCore.QAbstractTableModel):
+    HEADERS = ("Player Name", "Skill Level")
+
+    def __init__(self):
+        super().__init__()
+        self.sort_column = -1 # -1 is id order.
+        self.sort_order = Qt.AscendingOrder
+        self.filter = ""
+        self.rows = list() # row -> p_id
+        self.load_rows()
+
+    def load_rows(self):
+        players = database["PT"]
+        reverse = self.sort_order == Qt.DescendingOrder
+        if self.sort_column == 0:
+            # Already in name order in the index.
+            rows = [ None if p_id == -1 else p_id for name, p_id in player_order ]
+            if reverse:
+                rows.reverse()
+        else:
+            # The null player first, then the rest in the order they were created.
+            rows = [ None ]
+            rows.extend(sorted(p_id for p_id in players if p_id is not None))
+        if self.filter:
+            rows = [ p_id for p_id in rows if self.filter in players[p_id][0].casefold() ]
+        if self.sort_column == 1:
+            rows.sort(key = lambda p_id : players[p_id][1], reverse = reverse)
+        self.rows = rows
+
+    def reset(self):
+        self.beginResetModel()
+        self.load_rows()
+        self.endResetModel()
+
+    def set_filter(self, text):
+        self.filter = text.strip().casefold()
+        self.reset()
+
+    def sort(self, column, order = Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.reset()
+
+    def player_id(self, row):
+        return self.rows[row]
+
+    # Redraws the row of p_id after its name or skill changed.
+    def player_changed(self, p_id):
+        try:
+            row = self.rows.index(p_id)
+        except ValueError:
+            return
+        self.dataChanged.emit(self.index(row, 0), self.index(row, 1))
+
+    def rowCount(self, parent = QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent = QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        return str(database["PT"][self.rows[index.row()]][index.column()])
+
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+# END class PlayerTableModel
+
 # The main widget for player view mode.
 class PlayersWidget(QWidget):
     def __init__(self, parent):
         super().__init__(parent)
         self.setLayout(QHBoxLayout())
 
-        # Table Widget - Players and Skill Levels
-        self.table_widget = QTableWidget()
-        self.table_widget.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        #self.table_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        self.layout().addWidget(self.table_widget, 4)  # Set stretch factor to 4
-
-        # Set up table headers
-        self.table_widget.setColumnCount(2)
-        self.table_widget.setHorizontalHeaderLabels(["Player Name", "Skill Level"])
-
-        # Populate the table with player names and skill levels
-        p_id_list = [ p_id for p_id in database["PT"] if p_id is not None ]
-        p_id_list = sorted(p_id_list)
-        player_name, skill_level = database["PT"][None]
-        self.add_player_to_table(player_name, skill_level)
-        for p_id in p_id_list:
-            player_name, skill_level = database["PT"][p_id]
-            self.add_player_to_table(player_name, skill_level)
-        self.table_widget.setCurrentCell(0, 0)
+        # Table View - Players and Skill Levels, read from the database
+        # only for the rows on screen.
+        self.model = PlayerTableModel()
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter by name")
+        self.filter_edit.textChanged.connect(self.model.set_filter)
+        self.table_view = QTableView()
+        self.table_view.setModel(self.model)
+        self.table_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table_view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        # Unsorted until a header is clicked, rows stay in id order.
+        self.table_view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.table_view.setSortingEnabled(True)
+        #self.table_view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        table_layout = QVBoxLayout()
+        table_layout.addWidget(self.filter_edit)
+        table_layout.addWidget(self.table_view)
+        self.layout().addLayout(table_layout, 4)  # Set stretch factor to 4
+
+        self.table_view.setCurrentIndex(self.model.index(0, 0))
         self.tb = PlayerEditToolBox(self, None)
         self.layout().addWidget(self.tb, 1) # Set stretch factor to 1
         
-        # Connect the itemClicked signal to the on_item_clicked method
-        self.table_widget.itemClicked.connect(self.on_item_clicked)
-
-    def add_player_to_table(self, player_name, skill_level):
-        row_position = self.table_widget.rowCount()
-        self.table_widget.insertRow(row_position)
+        # Connect the clicked signal to the on_item_clicked method
+        self.table_view.clicked.connect(self.on_item_clicked)
 
-        name_item = QTableWidgetItem(player_name)
-        skill_item = QTableWidgetItem(str(skill_level))
-
-        self.table_widget.setItem(row_position, 0, name_item)
-        self.table_widget.setItem(row_position, 1, skill_item)
-
-    def on_item_clicked(self, item):
-        p_id = player_name_to_id(self.table_widget.item(item.row(), 0).text())
+    def on_item_clicked(self, index):
+        p_id = self.model.player_id(index.row())
         prev = self.tb
         self.tb = PlayerEditToolBox(self, p_id)
         self.layout().replaceWidget(prev, self.tb)
         prev.close()
 
+    # Players were created, deleted or changed elsewhere.
+    def refresh(self):
+        self.model.reset()
+        p_id = self.tb.p_id if self.tb.p_id in database["PT"] else None
+        # Also shows the player as it is now if an edit was undone.
+        if p_id != self.tb.p_id or database["PT"][p_id] != [ self.tb.name, self.tb.skill ]:
+            prev = self.tb
+            self.tb = PlayerEditToolBox(self, p_id)
+            self.layout().replaceWidget(prev, self.tb)
+            prev.close()
+
     def edit_name(self, new_name):
-        selected_row = self.table_widget.currentRow()
-        self.table_widget.item(selected_row, 0).setText(new_name)
+        self.model.player_changed(self.tb.p_id)
 
     def edit_skill(self, new_skill):
-        selected_row = self.table_widget.currentRow()
-        self.table_widget.item(selected_row, 1).setText(str(new_skill))
+        self.model.player_changed(self.tb.p_id)
         
 # END class PlayerWidget
 
@@ -1094,24 +2073,20 @@ class RPPCS_Main(QMainWindow):
     def __init__(self):
         super().__init__()
         
-        # Establish connection
-        global simple_client
-        factory = SimpleFactory()
-        reactor.connectTCP(ip, port, factory)
-        self.t = threading.Thread(target=reactor.run, args=(False,))
-        self.t.start()
-        # Wait until the connection is established.
-        # If a connection fails, print to console and exit program.
-        while simple_client is None:
-            if connection_failed:
-                print("Error connecting to server program.")
-                quit()
-        # Get database info
-        reactor.callFromThread(fetchall)
-        while database is None:
-            pass
-        
-        # print(database)
+        global player_list
+        player_list = PlayerListModel(self)
+        global score_timer
+        score_timer = QtCore.QTimer(self)
+        score_timer.setSingleShot(True)
+        score_timer.setInterval(SCORE_FLUSH_DELAY)
+        score_timer.timeout.connect(flush_scores)
+
+        signals.database_changed.connect(self.database_changed)
+        signals.connected.connect(self.connected)
+        signals.connection_failed.connect(self.connection_failed)
+        signals.connection_lost.connect(self.connection_lost)
+        signals.busy_changed.connect(self.busy_changed)
+        signals.edit_rolled_back.connect(self.edit_rolled_back)
         
         global WIN_X, WIN_Y
 
@@ -1121,6 +2096,7 @@ class RPPCS_Main(QMainWindow):
 
         self.temp_window = None
         self.t_widget = None
+        self.p_widget = None
         
         # Menu bar setup
         menu_bar = self.menuBar()
@@ -1158,21 +2134,91 @@ class RPPCS_Main(QMainWindow):
         p_button_action.triggered.connect(self.set_central_widget_players)
         toolbar.addAction(p_button_action)
 
+        # Everything but exit needs the database, enabled once it is loaded.
+        self.database_actions = [ test_action,
+                                  create_tournament_action, delete_tournament_action,
+                                  create_player_action, delete_player_action,
+                                  t_button_action, p_button_action ]
+        for action in self.database_actions:
+            action.setEnabled(False)
+
+        # Status bar showing what the server is busy with.
+        self.busy_label = QLabel()
+        self.busy_bar = QProgressBar()
+        self.busy_bar.setRange(0, 0) # No known length, just show activity.
+        self.busy_bar.setMaximumWidth(120)
+        self.busy_bar.hide()
+        self.statusBar().addWidget(self.busy_label)
+        self.statusBar().addPermanentWidget(self.busy_bar)
+
+        self.setCentralWidget(QLabel("Connecting to server...", alignment = Qt.AlignCenter))
+
+        # Establish connection. The reactor runs on its own thread and
+        # reports back through signals, so the window stays responsive.
+        factory = SimpleFactory()
+        self.connector = reactor.connectTCP(ip, port, factory)
+        self.t = threading.Thread(target=reactor.run, args=(False,))
+        self.t.start()
+
+    def connected(self):
+        global server_connected
+        server_connected = True
+        # Get database info. Subscribing first means every change made
+        # after the snapshot is pushed to us.
+        call_server("Loading database", start_session, done = self.session_started)
+
+    def session_started(self, result):
+        for action in self.database_actions:
+            action.setEnabled(True)
         self.set_central_widget_tournaments()
 
+    # If a connection fails, print to console and exit program.
+    def connection_failed(self):
+        print("Error connecting to server program.")
+        self.close()
+
+    # Nothing can be saved any more, the window stays open to be read.
+    def connection_lost(self):
+        global server_connected
+        server_connected = False
+        for action in self.database_actions:
+            action.setEnabled(False)
+        score_timer.stop()
+        flush_scores() # Fails at once, undoing the scores not sent.
+        fail_unanswered_edits()
+        signals.abandon_calls()
+        # Kept after the messages of the edits just undone time out.
+        self.busy_label.setText("Connection to the server lost, changes are no longer saved.")
+
+    def busy_changed(self, text):
+        self.busy_label.setText(text)
+        self.busy_bar.setVisible(bool(text))
+
+    def edit_rolled_back(self, text):
+        self.statusBar().showMessage(text, 5000)
+
     # This function is called when the qt window is closed.
     def closeEvent(self, event):
-        global simple_client
-        reactor.callFromThread(close_connection)
-        while simple_client is not None:
-            pass
+        flush_scores()
+        # The reactor stops once the connection is closed, or the attempt to
+        # make it given up, which ends its thread.
+        reactor.callFromThread(close_connection, self.connector)
         self.t.join()
         
     def escape_key(self):
         self.close()
 
     def test(self):
-        reactor.callFromThread(fetchall)
+        reactor.callFromThread(fetch_shared)
+
+    # Called on the GUI thread when a push from the server changed tables.
+    def database_changed(self, tables):
+        if "PT" in tables:
+            player_list.refresh()
+        if self.t_widget is not None:
+            self.t_widget.database_changed(tables)
+        elif self.p_widget is not None and "PT" in tables:
+            self.p_widget.refresh()
 
     def create_tournament(self):
         if self.temp_window is not None:
@@ -1216,30 +2262,77 @@ class RPPCS_Main(QMainWindow):
 
 class SimpleClient(protocol.Protocol):
     def connectionMade(self):
+        self.decoder = FrameDecoder()
         # Capture the protocol in the global variable simple_client
         # when a connection is successful.
         global simple_client
         simple_client = self
+        signals.connected.emit()
 
     def dataReceived(self, data):
-        decoded = data.decode()
-        if decoded == "Finished":
-            global finished
-            finished = True
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as e:
+            print(f"Corrupt data from server: {e}")
+            self.transport.loseConnection()
+            return
+
+        for msg_type, request_id, payload in frames:
+            self.frameReceived(msg_type, request_id, payload)
+
+    def frameReceived(self, msg_type, request_id, payload):
+        if request_id == PUSH_REQUEST_ID:
+            if msg_type == MSG_DELTA:
+                delta = json.loads(payload)
+                signals.gui_call.emit(lambda : delta_pushed(delta))
+            return
+
+        d = pending_requests.pop(request_id, None)
+        if d is None:
+            print(f"Response to unknown request {request_id}.")
+        elif msg_type == MSG_ERROR:
+            print(f"Server error: {payload.decode()}")
+            d.errback(CommandError(payload.decode()))
         else:
-            global database
-            global rcv_string
-            if database is None:
-                rcv_string += decoded # If the database is too long
-                try:
-                    database = eval(rcv_string)
-                except SyntaxError:
-                    pass
+            d.callback(self.responseReceived(msg_type, payload))
+
+    # Turns a response into the result of its command's Deferred. Snapshots
+    # and deltas are decoded here and applied to the local database on the
+    # GUI thread, in the order they arrive.
+    def responseReceived(self, msg_type, payload):
+        if msg_type == MSG_FINISHED:
+            return None
+        elif msg_type == MSG_SNAPSHOT:
+            start = time.perf_counter()
+            version, snapshot = decode_snapshot(payload)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"Snapshot: {len(payload)} bytes decoded in {elapsed:.1f} ms")
+            signals.gui_call.emit(lambda : snapshot_received(version, snapshot))
+            return None
+        elif msg_type == MSG_DELTA:
+            delta = json.loads(payload)
+            signals.gui_call.emit(lambda : delta_received(delta))
+            return None
+        elif msg_type == MSG_IDS:
+            return int(payload)
+        elif msg_type == MSG_HELLO:
+            return json.loads(payload)
+        # Binary payloads such as MSG_TOURNAMENT are left to the caller.
+        return payload
 
     def connectionLost(self, reason):
         global simple_client
         simple_client = None
         print(f"connection lost")
+        # Nothing more will arrive for the commands still in flight.
+        requests = list(pending_requests.values())
+        pending_requests.clear()
+        for d in requests:
+            d.errback(CommandError("Connection lost."))
+        if self.decoder.bytes_compressed > 0:
+            print(f"Received {self.decoder.bytes_compressed} compressed bytes for "
+                  f"{self.decoder.bytes_inflated} payload bytes, "
+                  f"{self.decoder.inflate_time * 1000:.1f} ms CPU decompressing.")
         
 # END SimpleClient
 
@@ -1248,13 +2341,15 @@ class SimpleFactory(protocol.ClientFactory):
     protocol = SimpleClient
         
     def clientConnectionFailed(self, connector, reason):
-        global connection_failed
-        connection_failed = True
         reactor.stop()
+        # Not an error if close_connection() gave up the attempt.
+        if not reason.check(error.UserError):
+            signals.connection_failed.emit()
 
     def clientConnectionLost(self, connector, reason):
         print("Connection lost - goodbye!")
         reactor.stop()
+        signals.connection_lost.emit()
         
 # END SimpleFactory
 
@@ -1328,6 +2423,7 @@ if __name__ == "__main__":
     network_init()
     
     app = QApplication([])
+    signals = ClientSignals()
     window = RPPCS_Main()
     window.show()
     app.exec()
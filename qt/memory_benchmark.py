@@ -0,0 +1,87 @@
+# Memory used by the client's copy of the matches, games and match tree
+# tables, stored as { row_id : [ values... ] } dicts (the old layout, and
+# still the layout of the tournament and player tables) against the
+# ColumnTable layout.
+#
+# Usage:
+#     python3 memory_benchmark.py [tournaments] [players per tournament]
+
+import sys
+import tracemalloc
+from array import array
+
+from main import ColumnTable, SNAPSHOT_TABLES
+
+# Rows shaped like the ones create_tournament() in db/server.py makes:
+# numplayers - 1 matches with 7 games each, and a tree edge for every
+# match that is not in the first round.
+def make_rows(tournaments, players):
+    rows = { "MT" : list(), "GT" : list(), "BT" : list() }
+    m_id = 0
+    g_id = 0
+    for t_id in range(tournaments):
+        first = m_id
+        for i in range(players - 1):
+            p1 = i * 2 if i < players // 2 else None
+            p2 = i * 2 + 1 if i < players // 2 else None
+            rows["MT"].append((m_id + i, t_id, p1, p2))
+            for j in range(7):
+                rows["GT"].append((g_id, m_id + i, 0, 0))
+                g_id += 1
+        m_id += players - 1
+        for i in range(players // 2, players - 1):
+            child = first + (i - players // 2) * 2
+            rows["BT"].append((first + i, child, child + 1))
+    return rows
+
+# Columns as decode_snapshot() reads them, NULL as -1.
+def to_columns(table_rows, kinds):
+    return [ array('q', [ -1 if row[i] is None else row[i] for row in table_rows ])
+             for i in range(len(kinds)) ]
+
+# Each layout is built from fresh arrays so only what it keeps is measured.
+def list_table(table_rows, kinds):
+    columns = to_columns(table_rows, kinds)
+    # Converting through the arrays makes new int objects per row, as the
+    # old decode_snapshot() did.
+    values = [ [ None if v == -1 and k == 'n' else v for v in column ]
+               for column, k in zip(columns[1:], kinds[1:]) ]
+    return dict(zip(columns[0], map(list, zip(*values))))
+
+def column_table(table_rows, kinds):
+    columns = to_columns(table_rows, kinds)
+    return ColumnTable(kinds[1:], columns[0], columns[1:])
+
+def measure(build, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = build(*args)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return table, size
+
+def main():
+    tournaments = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    rows = make_rows(tournaments, players)
+    kinds = dict(SNAPSHOT_TABLES)
+
+    print(f"{tournaments} tournaments of {players} players")
+    print(f"{'table':6}{'rows':>10}{'list B/row':>12}{'column B/row':>14}{'saved':>8}")
+    totals = [ 0, 0, 0 ]
+    for key in ("MT", "GT", "BT"):
+        lists, list_size = measure(list_table, rows[key], kinds[key])
+        table, column_size = measure(column_table, rows[key], kinds[key])
+        # Both layouts must hold the same rows.
+        assert all(table[row_id] == row for row_id, row in lists.items())
+        count = len(rows[key])
+        totals[0] += count
+        totals[1] += list_size
+        totals[2] += column_size
+        print(f"{key:6}{count:>10}{list_size / count:>12.1f}{column_size / count:>14.1f}"
+              f"{1 - column_size / list_size:>8.0%}")
+    print(f"{'total':6}{totals[0]:>10}{totals[1] / totals[0]:>12.1f}{totals[2] / totals[0]:>14.1f}"
+          f"{1 - totals[2] / totals[1]:>8.0%}")
+
+if __name__ == "__main__":
+    main()